@@ -1,68 +1,30 @@
-import numpy as np
-import pandas as pd
-from pandas.api.types import CategoricalDtype
-import plotly.graph_objects as go
-import plotly.figure_factory as ff
-import plotly.express as px
-from dash import Dash
+import profiling
+from dash import Dash, callback_context
+from dash.exceptions import PreventUpdate
 #from jupyter_dash import JupyterDash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output
-from matplotlib import pyplot as plt
-from matplotlib import colors as pltcolors
-from io import BytesIO
-import base64
+import os
+import json
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, abort, redirect, request
+import artifacts
+from gss_data import (GSSDataset, max_resident_years, cache_dir, xgb_csv,
+                    belief_questions, belief_default, source_fingerprint)
+import cube
+import pipeline
+import bootstrap
+import shap_store
+import response_cache
+import metrics
+import export
 
 
 #external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-gss_source = "https://raw.githubusercontent.com/kipmccharen/dash-heroku-template/master/gss2018.csv"
-xgb_csv = r"https://raw.githubusercontent.com/kipmccharen/dash-heroku-template/master/gss_xgboost_df.csv"
-
-gss = pd.read_csv(gss_source,
-                encoding='cp1252', 
-                na_values=['IAP','IAP,DK,NA,uncodeable', 'NOT SURE',
-                'DK', 'IAP, DK, NA, uncodeable', '.a', "CAN'T CHOOSE"])
-
-mycols = ['id', 'wtss', 'sex', 'educ', 'region', 'age', 'coninc',
-          'prestg10', 'mapres10', 'papres10', 'sei10', 'satjob',
-          'fechld', 'fefam', 'fepol', 'fepresch', 'meovrwrk'] 
-gss_clean = gss[mycols]
-gss_clean = gss_clean.rename({'wtss':'weight', 
-                              'educ':'education', 
-                              'coninc':'income', 
-                              'prestg10':'job_prestige',
-                              'mapres10':'mother_job_prestige', 
-                              'papres10':'father_job_prestige', 
-                              'sei10':'socioeconomic_index', 
-                              'fechld':'relationship', 
-                              'fefam':'male_breadwinner', 
-                              'fehire':'hire_women', 
-                              'fejobaff':'preference_hire_women', 
-                              'fepol':'men_bettersuited', 
-                              'fepresch':'child_suffer',
-                              'meovrwrk':'men_overwork'},axis=1)
-
-cat_order = ['strongly agree', 'agree', 
-    'neither agree nor disagree', 
-    'disagree', 'strongly disagree']
-cat_type = CategoricalDtype(categories=cat_order,
-                ordered=True)
-colorder = ['relationship', 'male_breadwinner',
-    'men_bettersuited', 'child_suffer', 'men_overwork']
-
-for c in colorder:
-    gss_clean[c] = gss_clean[c].astype(cat_type)
-
-cat_type_sex = CategoricalDtype(categories=["female", "male"],
-                ordered=True)
-gss_clean['sex'] = gss_clean['sex'].astype(cat_type_sex)
-
-gss_clean.age = gss_clean.age.replace({'89 or older':'89'})
-gss_clean.age = gss_clean.age.astype('float')
-
 gender_wage_gap_discussion = """## What is the Gender Wage Gap?
 
 "Working women are paid less than working men", as concisely reported 
@@ -99,199 +61,153 @@ levels of agreement with statements (like the one above) related to sex, family
 """
 
 #%%
-gss_grp = gss_clean[["sex", "income", "job_prestige", \
-                "socioeconomic_index", "education"]]
-gss_grp = round(gss_grp.groupby("sex").mean(),2).reset_index()
-gss_grp.columns = [x.replace("_", " ").title() \
-                for x in list(gss_grp.columns)]
-
-table = ff.create_table(gss_grp)
-
-bread = gss_clean[["sex", "male_breadwinner"]]
-bread = bread.value_counts().reset_index()
-bread.columns = ["Sex", "Male Breadwinner", "Count"]
-
-fig1 = px.bar(bread, x="Male Breadwinner", y="Count", color='Sex',
-            labels={'Count':'Count Of Response Selection', 
-            'Male Breadwinner':'Agreement levels to: <br>"It is much better for everyone involved <br>if the man is the achiever outside the home <br>and the woman takes care of the home and family."'},
-            barmode = 'group')
-fig1.update_layout(showlegend=True)
-fig1.update(layout=dict(title=dict(x=0.5)))
-
-#%%
-fig2 = px.scatter(gss_clean, x='job_prestige', y='income',
-                color = 'sex',
-                trendline='ols',
-                #height=600, width=600,
-                labels={'job_prestige':'Job Prestige', 
-                    'income':'Income'},
-                hover_data=['education', 'socioeconomic_index'])
-fig2.update(layout=dict(title=dict(x=0.5)))
-
-#%%
-gss_grp = pd.melt(gss_clean, id_vars=["sex"], 
-                value_vars=["income","job_prestige"], 
-                var_name="variable", 
-                value_name='value', ignore_index=True)
-
-fig3 = px.box(gss_grp, x='sex', y = 'value', 
-            color = 'sex',
-                facet_col='variable', 
-            labels={'sex':'', 'value':''})
-            
-fig3.for_each_annotation(lambda a: a.update( \
-    text=a.text.replace("variable=", "").replace("_", " ").title()))
-fig3.update_yaxes(matches=None)
-fig3.update_layout(showlegend=False)
-fig3.update(layout=dict(title=dict(x=0.5)))
-
-#%%
-gss6 = gss_clean[["income", "sex", "job_prestige"]]
-gss6['job_prest_grp'] = pd.cut(gss6.job_prestige, 6,
-                          labels = list(range(1,7)))
-gss6 = gss6.dropna()
-
-fig4 = px.box(gss6, x='sex', y = 'income',
-            color = 'sex', facet_col='job_prest_grp', 
-            color_discrete_map = {'male':'blue', 'female':'red'},
-            facet_col_wrap=2,
-            labels={'sex':'', 'value':''}, 
-            #width=600, 
-            height=600,
-            hover_data=['job_prestige'])
-            
-fig4.for_each_annotation(lambda a: a.update( \
-    text=a.text.replace("variable=", "").replace("_", " ").title()))
-fig4.update_yaxes(matches=None)
-fig4.update_layout(showlegend=False)
-fig4.update(layout=dict(title=dict(x=0.5)))
-
-sexcompare_avg = gss_clean.groupby('sex')['income'].mean()
-sexcompare_avg = sexcompare_avg.round(2).reset_index()
-sc_vals_avg = sexcompare_avg['income'].tolist()
-sx = ["female", "male"]
-
-sexcompare_med = gss_clean.groupby('sex')['income'].median()
-sexcompare_med = sexcompare_med.round(2).reset_index()
-sc_vals_med = sexcompare_med['income'].tolist()
-
-violins = px.violin(gss_clean, x="income", 
-            color="sex", box=True, 
-            points="all",
-            hover_data=gss_clean.columns)
-
+#survey years are only read when something asks for them
+dataset = GSSDataset()
+
+#every dataset, cube and figure is a node of a lazy graph, computed the
+#first time a page asks for it and again only when its source changes;
+#the beliefs page's year split keeps its small per-year cubes apart, one
+#column over every GSS wave and then some
+graph = pipeline.gss_pipeline(dataset,
+            maxsize=16 * max_resident_years,
+            likert_maxsize=int(os.environ.get("GSS_LIKERT_CUBES", 64)))
+
+#figure builds run on a few threads of their own, so a burst of heavy
+#pages can't take all of a gthread worker's request threads or its CPU
+figure_threads = int(os.environ.get("FIGURE_THREADS", 2))
+
+def _start_figure_pool():
+    global figure_pool
+    figure_pool = ThreadPoolExecutor(figure_threads, thread_name_prefix="figure")
+
+_start_figure_pool()
+#a pool's threads don't survive a fork, each gunicorn worker starts its own
+os.register_at_fork(after_in_child=_start_figure_pool)
+
+def build_figure(name, year):
+    """Figure [name] of [year] from the graph, built on the figure pool
+    unless it is already memoized."""
+    try:
+        return graph.peek(name, year=year)
+    except KeyError:
+        return figure_pool.submit(graph.get, name, year=year).result()
+
+#figures for the default year come pre-rendered from build_figures.py
+#when that has been run on this code and data, otherwise they come from
+#the graph too
+use_artifacts = artifacts.available(version=artifacts.build_version(
+        dataset.cumulative_source or dataset.source, xgb_csv()))
+if use_artifacts:
+    def default_figure(name):
+        return artifacts.load_figure(name)
+
+    page_image = artifacts.load_image
+    page_image_digest = artifacts.image_digest
+else:
+    def default_figure(name):
+        return build_figure(name, dataset.default_year)
+
+    def page_image(name, fmt="png"):
+        import figures
+        if fmt not in figures.image_formats:
+            raise KeyError(fmt)
+        try:
+            return graph.get(name, fmt=fmt)
+        except ValueError:
+            raise KeyError(fmt)
+
+    def page_image_digest(name, fmt="png"):
+        return artifacts.digest(page_image(name, fmt))
+
+#the importance chart is served from its own cacheable URL, see serve_image
+image_format = os.environ.get("IMAGE_FORMAT", "png")
+image_mimetypes = {"png": "image/png", "svg": "image/svg+xml", "webp": "image/webp"}
+
+def page_image_url(name, fmt=image_format):
+    """Content-hashed URL of page [name]'s image, png if [fmt] is unavailable."""
+    try:
+        return "/images/{}/{}.{}".format(page_image_digest(name, fmt), name, fmt)
+    except KeyError:
+        return "/images/{}/{}.png".format(page_image_digest(name, "png"), name)
+
+def page_figure(name, year=None):
+    """Figure for page [name] from survey [year] (default: latest)."""
+    if year is None or int(year) == dataset.default_year:
+        return default_figure(name)
+    return build_figure(name, int(year))
+
+#filtered aggregates are rolled up from a per-year cube instead of the frame
+def year_cube(year):
+    return graph.get("cube", year=year)
+
+age_range = [cube.age_edges[0], cube.age_edges[-1]]
+
+def cube_filters(region, education, age):
+    """GSSCube filter arguments from the filter controls."""
+    filters = {}
+    if region:
+        filters["region"] = region
+    if education:
+        filters["education"] = education
+    if age and list(age) != age_range:
+        filters["age"] = tuple(age)
+    return filters
+
+def filter_controls(year):
+    """Region, education and age filters for the aggregate pages."""
+    regions = year_cube(int(year or dataset.default_year)).labels["region"]
+    return dbc.Row([
+        dbc.Col([html.Label("Region"),
+            dcc.Dropdown(id="filter-region", multi=True,
+                options=[{"label": r.title(), "value": r} for r in regions],
+                style={"color": "black"})]),
+        dbc.Col([html.Label("Education"),
+            dcc.Dropdown(id="filter-education", multi=True,
+                options=[{"label": e, "value": e} for e in cube.educ_bands],
+                style={"color": "black"})]),
+        dbc.Col([html.Label("Age"),
+            dcc.RangeSlider(id="filter-age", min=age_range[0], max=age_range[1],
+                step=5, value=age_range,
+                marks={a: str(a) for a in cube.age_edges[::3]})]),
+        dbc.Col(html.A("Download these rows (CSV)", id="export-link",
+                href="/export/gss.csv", download="gss.csv"),
+            width="auto", style={"align-self": "flex-end"}),
+    ], className="live-only", style={"margin-bottom": "1rem"})
+
+filter_inputs = [Input("filter-region", "value"),
+                Input("filter-education", "value"),
+                Input("filter-age", "value"),
+                Input("year", "value")]
 
 #%%
-#define categories of items
-labelsdicts = [{"name": "Born Female", "inkey": ["SEX: Female"], 
-                "order": 2, "color":"orangered"},
-        {"name": "Hometown Region", "inkey": ["REGION"], 
-                "order": 4, "color":"dimgrey"},
-        {"name": "Beliefs", "inkey": ["gree", "isfied", "Dissat"], 
-                "order": 3, "color":"midnightblue"},
-        {"name": "Upbringing/Age", "inkey": [], 
-                "order": 1, "color":"black"}]
-
-def anylist_in_string(src_list, string):
-    """Return True if any value in [src_list] 
-    exists in given [string]."""
-    if not src_list or not string:
-        return False
-    for sl in src_list:
-        if sl in string:
-            return True
-    return False
-
-def addcolor(x):
-    """Vectorized color value from lookup dictionary."""
-    out = None
-    for ld in [a for a in labelsdicts if a["inkey"]]:
-        if anylist_in_string(ld['inkey'], x):
-            out = ld["color"]
-    if not out:
-        out = "black"
-    return pltcolors.to_rgba(out)
-
-#from https://github.com/4QuantOSS/DashIntro/blob/master/notebooks/Tutorial.ipynb
-def fig_to_uri(in_fig, close_all=True, **save_args):
-    # type: (plt.Figure) -> str
-    """
-    Save a figure as a URI
-    :param in_fig:
-    :return:
-    """
-    out_img = BytesIO()
-    in_fig.savefig(out_img, format='png', **save_args)
-    if close_all:
-        in_fig.clf()
-        plt.close('all')
-    out_img.seek(0)  # rewind file
-    encoded = base64.b64encode(out_img.read()).decode("ascii").replace("\n", "")
-    return "data:image/png;base64,{}".format(encoded)
-
-xg_df = pd.read_csv(xgb_csv)
-
-#add color to each feature from dict above
-xg_df['color'] = xg_df.feature.apply(addcolor)
-
-#set base font size
-plt.rcParams.update({'font.size': 10})
-
-#create plot and set figure size
-statfig,statax = plt.subplots(figsize = (8,12))
-
-#create bar chart
-statax.barh(xg_df.feature, xg_df.imp_pct, align='center')
-#add feature names as labels
-statax.set_yticks(xg_df.feature)
-#turn on size to make horizontal bar chart
-statax.invert_yaxis()
-#remove outer box and x axis as unnecessary
-statax.spines["top"].set_visible(False)
-statax.spines["right"].set_visible(False)
-statax.spines["bottom"].set_visible(False)
-statax.get_xaxis().set_visible(False)
-
-# for each feature:
-# - add text to end of bar
-# - color the bar itself
-for i in range(len(xg_df.index)):
-    rw = xg_df.iloc[i,:]
-
-    #add text to end of each bar with appropriate color
-    statax.text(x=rw['imp_pct'] +0.1, y=i, 
-            s=str(round(rw['imp_pct'],2)) + '%',
-            va = 'center', 
-            color=rw["positive"],
-            fontweight='bold')
-    #statax color of each bar
-    statax.get_children()[i].set_color(rw["color"])
-
-tsh = 12 #text start height
-
-#for each category of bar, add text in the plot
-for use_item in labelsdicts:
-    statax.text(7, tsh-6+use_item["order"]*1.2,
-            use_item["name"], 
-            color=pltcolors.to_rgba(use_item["color"]), 
-            fontsize='large', 
-            fontweight='bold')
-
-#add text explaining meaning of number color
-statax.text(7,tsh + 1.5,"reduces",color="red",fontweight='bold')
-statax.text(11,tsh + 1.5,"increases",color="black",fontweight='bold')
-
-#final labels
-#statax.set_title("AI-Predicted % Importance on Income\n(independent of other features)")
-#statax.text(5,tsh + 4,"Source: 2018 General Social Survey (GSS)")
-statax.set_ylabel('')
-plt.gcf().subplots_adjust(left=0.4, bottom=0.01, top=1)
-
-xgplot = fig_to_uri(statfig)
-
-#%%
-app = Dash(__name__, external_stylesheets=[dbc.themes.DARKLY])
+app = Dash(__name__, external_stylesheets=[dbc.themes.DARKLY],
+        #page components like violin-graph only exist once their page is rendered
+        suppress_callback_exceptions=True)
 server = app.server
+
+if profiling.enabled:
+    @server.route("/_debug/startup")
+    def startup_report():
+        """Per-stage startup time and memory, see profiling.py."""
+        return Response(json.dumps(profiling.report(), indent=1),
+                mimetype="application/json")
+
+@server.route("/images/<digest>/<name>.<fmt>")
+def serve_image(digest, name, fmt):
+    """Image bytes under a content-hashed URL, so they can be cached for
+    good; a stale hash redirects to the current URL."""
+    if fmt not in image_mimetypes:
+        abort(404)
+    try:
+        current = page_image_digest(name, fmt)
+    except (KeyError, OSError):
+        abort(404)
+    if digest != current:
+        return redirect(page_image_url(name, fmt))
+    resp = Response(page_image(name, fmt), mimetype=image_mimetypes[fmt])
+    resp.set_etag(current)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp.make_conditional(request)
 # ;
 # ;
 # style={'fontColor': 'blue', 'background'='rgb(2,0,36)',
@@ -324,6 +240,8 @@ sidebar = html.Div(
                     href="/table", id="table"),
                 dbc.NavLink("Traditional Gender Role Agreement", 
                     href="/roles", id="roles"),
+                dbc.NavLink("Beliefs and Job Satisfaction",
+                    href="/beliefs", id="beliefs"),
                 dbc.NavLink("Job Prestige/Income/Sex", 
                     href="/prestige", id="prestige"),
                 dbc.NavLink("Income and Prestige Distributions",
@@ -331,11 +249,22 @@ sidebar = html.Div(
                 dbc.NavLink("Prestige Levels", 
                     href="/income_dist", id="income_dist"),
                 dbc.NavLink("AI Importance", 
-                    href="/AI", id="AI")
+                    href="/AI", id="AI"),
+                dbc.NavLink("Explain a Respondent",
+                    href="/explain", id="explain")
             ],
             vertical=True,
             pills=True,
         ),
+        html.Hr(),
+        html.Div([html.Label("Survey Year"),
+            dcc.Dropdown(id="year",
+                options=[{"label": str(y), "value": y} for y in dataset.years()],
+                value=dataset.default_year,
+                clearable=False,
+                style={"color": "black"})],
+            #controls marked live-only are left out of snapshot.py's static pages
+            className="live-only"),
     ],
     style=SIDEBAR_STYLE,
 )
@@ -368,8 +297,8 @@ content = html.Div(id="page-content", style=CONTENT_STYLE)
 
 app.layout = html.Div([dcc.Location(id="url"), sidebar, content])
 
-pages = ['wage_gap-gss', 'violin', 'table', 'roles', 
-        'prestige', 'diff_dist', 'income_dist', 'AI']
+pages = ['wage_gap-gss', 'violin', 'table', 'roles', 'beliefs',
+        'prestige', 'diff_dist', 'income_dist', 'AI', 'explain']
 pagecount = len(pages)
 # this callback uses the current pathname to set the active state of the
 # corresponding nav link to true, allowing users to tell see page they are on
@@ -384,8 +313,9 @@ def toggle_active_links(pathname):
     return [pathname == f"/{i}" for i in pages]
 
 
-@app.callback(Output("page-content", "children"), [Input("url", "pathname")])
-def render_page_content(pathname):
+@app.callback(Output("page-content", "children"),
+            [Input("url", "pathname"), Input("year", "value")])
+def render_page_content(pathname, year=None):
     if pathname in ["/", "/wage_gap-gss"]:
         return html.P([html.Div([
                 html.H1("The Wage Gap According To GSS Data"),
@@ -397,7 +327,9 @@ def render_page_content(pathname):
     elif pathname == "/violin":
         return html.P([
                 html.H2("Income Violin Plots by Sex"),
-                dcc.Graph(figure=violins),
+                dcc.Loading(dcc.Graph(id="violin-graph")),
+                dbc.Button("Show all points", id="violin-full",
+                    color="secondary", size="sm", className="live-only"),
                 dcc.Markdown(children = """According to data from the GSS, do men have higher incomes than women?
                 
                 While complicated, it appears that the answer is yes. While the median income for men and women is the same, the average is lower for women, and we can see both the first and third quartile breaks are lower for women. """)
@@ -405,41 +337,79 @@ def render_page_content(pathname):
     elif pathname == "/table":
         return html.P([
                 html.H2("Summary Data by Sex"),
-                dcc.Graph(figure=table),
+                filter_controls(year),
+                dcc.Graph(id="table-graph"),
+                dcc.Markdown(id="income-compare"),
                 dcc.Markdown(children = """The average differences in prestige, socioeconomic index, and education are not very different between men and women. It's peculiar that income is so much more different than these other factors.""")
             ])
     elif pathname == "/roles":
         return html.P([
                 html.H2("Agreement with Traditional Gender Roles by Sex"),
-                dcc.Graph(figure=fig1),
+                filter_controls(year),
+                dcc.Graph(id="roles-graph"),
                 dcc.Markdown(children = """In terms of agreeing that women should take care of the home and family, both sexes are in generally similar ratios in all categories except for strongly disagree which is about 2/3 women.""")
             ])
+    elif pathname == "/beliefs":
+        return html.P([
+                html.H2("Beliefs and Job Satisfaction by Sex"),
+                dbc.Row([
+                    dbc.Col([html.Label("Question"),
+                        dcc.Dropdown(id="belief-column", value=belief_default,
+                            clearable=False, style={"color": "black"},
+                            options=[{"label": q, "value": c}
+                                    for c, q in belief_questions.items()])]),
+                    dbc.Col([html.Label("Split by"),
+                        dcc.RadioItems(id="belief-split", value="none",
+                            options=[{"label": " " + s.title(), "value": s}
+                                    for s in ["none", "region", "year"]],
+                            labelStyle={"margin-right": "1rem"})], width="auto"),
+                ], className="live-only", style={"margin-bottom": "1rem"}),
+                filter_controls(year),
+                dcc.Graph(id="beliefs-graph"),
+                dcc.Markdown(children = """Shares are survey-weighted and leave out respondents who did not answer. Splitting by year shows every survey year, whatever year is selected on the left.""")
+            ])
     elif pathname == "/prestige":
         return html.P([
                 html.H2("Job Prestige vs Income, Colors by Sex"),
-                dcc.Graph(figure=fig2),
+                dcc.Loading(dcc.Graph(id="prestige-graph")),
                 dcc.Markdown(children = """Job prestige has a very similar impact on income between men and women, the average lines are in the same direction and almost lining up but not quite. Women's income grows slightly less across prestige levels.""")
             ])
     elif pathname == "/diff_dist":
         return html.P([
                 html.H2("Differences in Distribution by Sex\r\nof Income and Job Prestige"),
-                dcc.Graph(figure=fig3),
+                dcc.Loading(dcc.Graph(id="diff_dist-graph")),
                 dcc.Markdown(children = """Building off the violin plots, if we compare the difference in job prestige between men and women, they are almost the same at every point. On average, women even have higher prestige jobs than men, albeit with a lower window. These don't seem to agree at all!""")
             ])
     elif pathname == "/income_dist":
         return html.P([
                 html.H2("Income Distributions by Sex\r\nacross equally sized Job Prestige Levels 1-6"),
-                dcc.Graph(figure=fig4),
+                filter_controls(year),
+                dcc.Graph(id="income_dist-graph"),
                 dcc.Markdown(children = """Even if we break down groups in 6 separate categories (1 is lowest, 6 is highest prestige), in terms of actually getting paid given their prestige, once again we see either parity or higher male income at every part of the distribution.""")
             ])
     elif pathname == "/AI":
         return html.P([
                 html.H2("AI-Predicted % Importance on\r\nIncome (independent of other features)"),
-                html.Div([html.Img(src=xgplot)]),
+                html.Div([html.Img(src=page_image_url("AI"))]),
                 dcc.Markdown(children = """Independent of other features, it seems like age, prestige, and education have the biggest overall impact on income, and as each one increases, so too does income. These are not particularly surprising or interesting, so they are all black. 
 
 The other bar colors demonstrate that sex had a larger impact than any belief or hometown region category. The percent impact color tells us that being female had a negative impact on income. Other factors that had a negative impact on income seem to be beliefs which are less than extreme (agree, disagree, or neither agree nor disagree), or in short: apathy. """)
             ])
+    elif pathname == "/explain":
+        store = shap_store.open_store()
+        if store is None:
+            return html.P([html.H2("Explain a Respondent"),
+                dcc.Markdown("No explanations yet, run `python shap_store.py` to build them.")])
+        return html.P([
+                html.H2("Why Does the Model Predict This Income?"),
+                html.Div([html.Label("Respondent id"),
+                    dcc.Input(id="respondent-id", type="number", debounce=True,
+                        value=int(store.ids[0]), min=int(store.ids[0]), max=int(store.ids[-1]))],
+                    className="live-only"),
+                dcc.Markdown(id="explain-text"),
+                dcc.Graph(id="explain-graph"),
+                dcc.Markdown(children = """Each bar is how much one answer moves this respondent's predicted income away from the average prediction, according to the AI model on the previous page. Red bars lower the prediction, black bars raise it.""")
+            ])
     # If the user tries to reach a different page, return a 404 message
     return dbc.Jumbotron(
         [
@@ -449,6 +419,233 @@ The other bar colors demonstrate that sex had a larger impact than any belief or
         ]
     )
 
+# the aggregate pages fill their graphs here, straight from the stored
+# figure when nothing is filtered and from the year's cube otherwise
+@app.callback([Output("table-graph", "figure"),
+            Output("income-compare", "children")], filter_inputs)
+def update_table(region, education, age, year):
+    filters = cube_filters(region, education, age)
+    c = year_cube(int(year or dataset.default_year))
+    avg = c.means(weighted=True, **filters).set_index("sex")["income"]
+    med = c.quantiles([0.5], weighted=True, **filters).set_index("sex")[0.5]
+    #a binned income sketch only approximates the median
+    approx = "" if c.income_exact else "~"
+    compare = "**Income by sex (survey-weighted)** " + ", ".join(
+        "{}: mean ${:,.0f}, median {}${:,.0f}".format(sx, avg[sx], approx, med[sx])
+        for sx in avg.index)
+    if not filters:
+        #bootstrap.py intervals are for the whole sample only
+        gap = bootstrap.year_intervals(year or dataset.default_year).get("gap")
+        if gap:
+            compare += "\n\n**Male - female gap ({:.0%} bootstrap interval)** ".format(
+                    bootstrap.load_intervals().get("level", 0.95)) + ", ".join(
+                "{}: ${:,.0f} (${:,.0f} to ${:,.0f})".format(
+                    stat, g["estimate"], g["lo"], g["hi"]) for stat, g in gap.items())
+        return page_figure("table", year), compare
+    import figures
+    return figures.table_figure(c.means(weighted=True, **filters)), compare
+
+@app.callback(Output("roles-graph", "figure"), filter_inputs)
+def update_roles(region, education, age, year):
+    filters = cube_filters(region, education, age)
+    if not filters:
+        return page_figure("roles", year)
+    import figures
+    counts = year_cube(int(year or dataset.default_year)).counts(
+                "male_breadwinner", **filters)
+    bread = counts.stack().reset_index()
+    bread.columns = ["Sex", "Male Breadwinner", "Count"]
+    return figures.roles_figure(bread)
+
+#answers to every belief column by sex (and region or year) come from the
+#Likert slots of the year's cube, see GSSCube.crosstab; the year split
+#uses the small per-year "likert" cubes, so it keeps no year resident
+@app.callback(Output("beliefs-graph", "figure"),
+            [Input("belief-column", "value"), Input("belief-split", "value")] + filter_inputs)
+def update_beliefs(column, split, region, education, age, year):
+    filters = cube_filters(region, education, age)
+    column = column or belief_default
+    if column == belief_default and split in (None, "none") and not filters:
+        return page_figure("beliefs", year)
+    import figures
+    if split == "year":
+        tab = cube.crosstab_years({y: graph.get("likert", year=y, column=column)
+                    for y in dataset.years()}, [column], **filters)
+        return figures.beliefs_figure(tab, column, "year")
+    by = ("sex", "region") if split == "region" else ("sex",)
+    tab = year_cube(int(year or dataset.default_year)).crosstab([column], by, **filters)
+    return figures.beliefs_figure(tab, column, "region" if split == "region" else None)
+
+@app.callback(Output("income_dist-graph", "figure"), filter_inputs)
+def update_income_dist(region, education, age, year):
+    filters = cube_filters(region, education, age)
+    if not filters:
+        return page_figure("income_dist", year)
+    import figures
+    stats = year_cube(int(year or dataset.default_year)).box_stats(
+                by=("prestige", "sex"), weighted=True, **filters)
+    return figures.income_dist_figure(stats)
+
+# pages come back as a shell and their figures follow in their own
+# requests, so a slow figure doesn't hold up the rest of the page.
+# the violin page starts with the summary figure, the full
+# resolution points are only sent when asked for
+@app.callback(Output("violin-graph", "figure"),
+            [Input("violin-full", "n_clicks"), Input("year", "value")])
+def update_violin(n_clicks, year=None):
+    return page_figure("violin_full" if n_clicks else "violin", year)
+
+def zoom_ranges(relayout):
+    """(x range, y range) a plotly relayoutData event zoomed to, None
+    for an axis it autoranged, or None if the event is not a zoom."""
+    relayout = relayout or {}
+    ranges = []
+    for axis in ("xaxis", "yaxis"):
+        if "{}.range[0]".format(axis) in relayout:
+            ranges.append((relayout["{}.range[0]".format(axis)],
+                        relayout["{}.range[1]".format(axis)]))
+        elif "{}.range".format(axis) in relayout:
+            ranges.append(tuple(relayout["{}.range".format(axis)]))
+        else:
+            ranges.append(None)
+    if ranges == [None, None]:
+        return None
+    return ranges
+
+# zoomed out the prestige page is a density per sex, zooming in fetches
+# the points (or a finer density) for just the region in view
+@app.callback(Output("prestige-graph", "figure"),
+            [Input("year", "value"), Input("prestige-graph", "relayoutData")])
+def update_prestige(year=None, relayout=None):
+    triggered = [t["prop_id"] for t in callback_context.triggered]
+    ranges = zoom_ranges(relayout)
+    if "prestige-graph.relayoutData" in triggered and ranges is None \
+            and not any(k.endswith("autorange") for k in relayout or {}):
+        #resizes and the like, the figure stays as it is
+        raise PreventUpdate
+    if ranges is None or "year.value" in triggered:
+        return page_figure("prestige", year)
+    import figures
+    points = graph.get("prestige_points", year=int(year or dataset.default_year))
+    return figures.prestige_figure(points, *ranges)
+
+@app.callback(Output("diff_dist-graph", "figure"), [Input("year", "value")])
+def update_diff_dist(year=None):
+    return page_figure("diff_dist", year)
+
+# the rows behind the filtered charts, streamed by export.py
+@app.callback(Output("export-link", "href"), filter_inputs)
+def update_export_link(region, education, age, year):
+    params = [("year", year or dataset.default_year)]
+    params += [("region", r) for r in region or []]
+    params += [("education_band", e) for e in education or []]
+    if age and list(age) != age_range:
+        params.append(("age", "{}-{}".format(*age)))
+    return "/export/gss.csv?" + urlencode(params)
+
+# latency, size and errors of every callback, per page, at /metrics
+def callback_page(payload):
+    """Page a callback request belongs to: the pathname for the page
+    itself, the graph id's prefix (violin-graph -> violin) otherwise."""
+    if payload.get("output") == "page-content.children":
+        for i in payload.get("inputs", []):
+            if i.get("id") == "url":
+                path = (i.get("value") or "/").strip("/")
+                return path or pages[0]
+    return payload.get("output", "").strip(".").split("-graph")[0]
+
+callback_metrics = metrics.CallbackMetrics(pages)
+metrics.install(server, callback_metrics, callback_page)
+export.install(server, dataset)
+#pages pre-rendered by snapshot.py, served as files (?live=1 skips them)
+if os.environ.get("SNAPSHOT_DIR"):
+    import snapshot
+    snapshot.install(server, os.environ["SNAPSHOT_DIR"])
+
+# one respondent's row is sliced out of the memory-mapped SHAP store
+@app.callback([Output("explain-graph", "figure"),
+            Output("explain-text", "children")],
+            [Input("respondent-id", "value")])
+def explain_respondent(respondent):
+    import figures
+    store = shap_store.open_store()
+    try:
+        explanation = store.explain(int(respondent))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return {}, "No respondent with id {} reported an income.".format(respondent)
+    text = ("**Predicted income ${:,.0f}** (reported ${:,.0f}, average prediction ${:,.0f})"
+            .format(explanation["prediction"], explanation["income"], explanation["bias"]))
+    return figures.explain_figure(explanation), text
+
+# callbacks whose output depends only on their inputs, their responses
+# are kept (already compressed) and sent again for the same inputs
+pure_outputs = ["page-content.children", "table-graph.figure",
+                "roles-graph.figure", "income_dist-graph.figure",
+                "beliefs-graph.figure",
+                "explain-graph.figure", "violin-graph.figure",
+                "prestige-graph.figure", "diff_dist-graph.figure"]
+#of those, the ones that look at which input fired (callback_context.triggered)
+triggered_outputs = ["prestige-graph.figure"]
+
+shared_cache = {"file": lambda: response_cache.FileCache(
+                        os.path.join(cache_dir, "responses"),
+                        int(os.environ.get("RESPONSE_CACHE_FILE_MB", 256)) * 2**20),
+                "memory": response_cache.MemoryCache
+                }.get(os.environ.get("RESPONSE_CACHE_SHARED", ""), lambda: None)()
+
+#what only a new deploy changes, worked out once
+build_key = json.dumps([os.environ.get("SOURCE_VERSION", ""),
+    artifacts.build_version(dataset.cumulative_source or dataset.source, xgb_csv(),
+        artifacts.code_files + ["app.py", "pipeline.py", "bootstrap.py"])],
+    sort_keys=True)
+
+def response_version():
+    """Everything a cached response depends on besides its inputs: the
+    code and data it was deployed with, and the files rebuilt while the
+    app runs (the bootstrap intervals, the SHAP store, the data and the
+    importance csv), checked on every request. Workers that did not
+    fork from one master agree on it."""
+    files = [bootstrap.intervals_json, os.path.join(shap_store.store_dir, "meta.json"),
+            dataset.cumulative_source or dataset.source, xgb_csv()]
+    return json.dumps([build_key] + [source_fingerprint(f) for f in files])
+
+callback_cache = response_cache.ResponseCache(
+    maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", 256)),
+    shared=shared_cache,
+    version=response_version)
+response_cache.install(server, callback_cache,
+    [k for k in app.callback_map if any(o in k for o in pure_outputs)],
+    [k for k in app.callback_map if any(o in k for o in triggered_outputs)])
+
+def warm():
+    """Load what every worker needs once, in the gunicorn master before
+    it forks (see gunicorn.conf.py): the default year's frame and cube,
+    and each page's and each figure's first response, already serialized
+    and compressed in the response cache, so workers share them instead
+    of building their own."""
+    year = dataset.default_year
+    year_cube(year)
+    client = server.test_client()
+
+    def post(output, inputs):
+        client.post("/_dash-update-component", json={
+            "output": output,
+            "outputs": {"id": output.split(".")[0], "property": output.split(".")[1]},
+            "inputs": [{"id": i, "property": p, "value": v} for i, p, v in inputs],
+            "changedPropIds": []})
+
+    for page in pages:
+        post("page-content.children", [("url", "pathname", "/" + page), ("year", "value", year)])
+    post("violin-graph.figure", [("violin-full", "n_clicks", None), ("year", "value", year)])
+    for name in ["prestige", "diff_dist"]:
+        post(name + "-graph.figure", [("year", "value", year)])
+    post("beliefs-graph.figure", [("belief-column", "value", belief_default),
+            ("belief-split", "value", "none"), ("filter-region", "value", None),
+            ("filter-education", "value", None), ("filter-age", "value", age_range),
+            ("year", "value", year)])
+    #warming is not traffic
+    callback_metrics.reset()
+
 
 # app.layout = html.Div(
 #     [   dcc.Location(id="url"), sidebar, 
@@ -510,5 +707,7 @@ The other bar colors demonstrate that sex had a larger impact than any belief or
 #     ] #, style=backgroundcolor
 # )
 
+profiling.ready()
+
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+from profiling import stage
+
+#pre-rendered figures live here; runtime only needs json/os, never plotly.express
+artifact_dir = os.environ.get("FIGURE_ARTIFACTS",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "artifacts"))
+
+manifest_name = "manifest.json"
+
+#modules whose code shapes the stored figures and images
+code_files = ["figures.py", "trendline.py", "survey_stats.py",
+            "xgboost_analysis.py", "gss_data.py", "cube.py", "build_figures.py"]
+
+def build_version(gss_source, xgb_source, code_files=code_files):
+    """What a build is made from: the cleaned data of [gss_source], the
+    importance csv [xgb_source] and the code in [code_files]. Nothing in
+    it depends on where the files are, a slug is built in one directory
+    and run from another."""
+    from gss_data import clean_config
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = hashlib.sha256()
+    for name in code_files:
+        with open(os.path.join(here, name), "rb") as f:
+            code.update(f.read())
+    #a local GSS file can be large, its name and size stand in for it
+    data = gss_source
+    if os.path.exists(gss_source):
+        data = "{}|{}".format(os.path.basename(gss_source), os.path.getsize(gss_source))
+    xgb = xgb_source
+    if os.path.exists(xgb_source):
+        with open(xgb_source, "rb") as f:
+            xgb = digest(f.read())
+    return {"data": digest(json.dumps([data, clean_config()], sort_keys=True).encode()),
+            "xgb": xgb, "code": code.hexdigest()[:16]}
+
+def available(path=artifact_dir, version=None):
+    """True if a finished build exists at [path], made from [version]
+    (see build_version) when one is given."""
+    if not os.path.exists(os.path.join(path, manifest_name)):
+        return False
+    return version is None or load_manifest(path).get("version") == version
+
+def _write(path, data):
+    #write to a temp name first so a half-written artifact is never served
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def digest(data):
+    """Short content hash used in manifests and image URLs."""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def save_all(figs, images, path=artifact_dir, version=None):
+    """Write {page: plotly figure} as json and {page: {format: bytes}}
+    as image files to [path], then the manifest listing them and the
+    [version] they were built from."""
+    os.makedirs(path, exist_ok=True)
+    manifest = {"version": version, "figures": {}, "images": {}}
+    for name, fig in figs.items():
+        with stage("serialize", artifact=name + ".json"):
+            data = fig.to_json().encode("utf-8")
+            _write(os.path.join(path, name + ".json"), data)
+        manifest["figures"][name] = digest(data)
+    for name, formats in images.items():
+        manifest["images"][name] = {}
+        for fmt, img in formats.items():
+            _write(os.path.join(path, "{}.{}".format(name, fmt)), img)
+            manifest["images"][name][fmt] = digest(img)
+    #manifest goes last, it is what marks the build as finished
+    _write(os.path.join(path, manifest_name),
+            json.dumps(manifest, indent=1).encode("utf-8"))
+    _loaded.clear()
+    return manifest
+
+_loaded = {}
+
+def load_figure(name, path=artifact_dir):
+    """Figure dict for page [name], read from disk on first use."""
+    key = (path, name, "json")
+    if key not in _loaded:
+        with stage("deserialize", artifact=name + ".json"), \
+                open(os.path.join(path, name + ".json"), encoding="utf-8") as f:
+            _loaded[key] = json.load(f)
+    return _loaded[key]
+
+def load_manifest(path=artifact_dir):
+    key = (path, manifest_name)
+    if key not in _loaded:
+        with open(os.path.join(path, manifest_name), encoding="utf-8") as f:
+            _loaded[key] = json.load(f)
+    return _loaded[key]
+
+def load_image(name, fmt="png", path=artifact_dir):
+    """Image bytes for page [name] in [fmt], read from disk on first use."""
+    key = (path, name, fmt)
+    if key not in _loaded:
+        with open(os.path.join(path, "{}.{}".format(name, fmt)), "rb") as f:
+            _loaded[key] = f.read()
+    return _loaded[key]
+
+def image_digest(name, fmt="png", path=artifact_dir):
+    """Content hash of a stored image, KeyError if it was not built."""
+    return load_manifest(path)["images"][name][fmt]
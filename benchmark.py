@@ -0,0 +1,278 @@
+"""Benchmarks for the dashboard's pages, callbacks and pipeline stages.
+
+    python benchmark.py load --source gss2018.csv [-c 1 8] [-n 50] [--out load.json]
+    python benchmark.py stages --source gss2018.csv [--repeat 5] [--out stages.json]
+    python benchmark.py compare OLD.json NEW.json
+
+load serves app.server from this process on a local port (or drives
+--url, e.g. a gunicorn started by hand, with --pid for its memory) and
+sends every page in app.pages, each page's page-content request and
+every other callback in the app with the inputs a browser sends on
+first load. Each case is sent once on its own (first_ms, usually a
+cache miss) and then --requests times from --concurrency threads.
+Reported per case and concurrency: p50/p95/p99 latency, throughput,
+bytes on the wire and the server's RSS and PSS afterwards.
+
+stages times each step on its own: reading and cleaning the source,
+compacting, the memory-mapped year files, every node of the figure
+pipeline with its inputs already computed, and serializing each figure
+to JSON as Dash does.
+
+The data and the importance csv always come from local files, never the
+GitHub URLs, so runs are comparable. Results are JSON; compare prints
+the change per case.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from callback_requests import callback_body, first_load_values
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+def run_info(args):
+    """Where and what a run measured, saved with its results."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir,
+                    capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "args": vars(args)}
+
+def load_cases(app):
+    """[{"name", "method", "path", "body"}] for every page and callback
+    of the app module [app], with first-load input values."""
+    values = first_load_values(app)
+    cases = []
+    for page in app.pages:
+        cases.append({"name": "GET /" + page, "method": "GET", "path": "/" + page})
+    for output, callback in app.app.callback_map.items():
+        inputs = [(i["id"], i["property"]) for i in callback["inputs"]]
+        if output == "page-content.children":
+            for page in app.pages:
+                values[("url", "pathname")] = "/" + page
+                cases.append({"name": "page-content /" + page, "method": "POST",
+                            "path": "/_dash-update-component",
+                            "body": callback_body(output, inputs, values)})
+            continue
+        values[("url", "pathname")] = "/"
+        body = callback_body(output, inputs, values)
+        cases.append({"name": output.strip(".").split("...")[0], "method": "POST",
+                    "path": "/_dash-update-component", "body": body})
+    return cases
+
+def send(url, case, encoding):
+    """(status, bytes on the wire) of one request."""
+    data = json.dumps(case["body"]).encode("utf-8") if case.get("body") else None
+    req = urllib.request.Request(url + case["path"], data, method=case["method"],
+            headers={"Content-Type": "application/json", "Accept-Encoding": encoding})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, len(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, len(e.read())
+
+def process_memory(pid):
+    """{"rss_bytes", "pss_bytes"} of [pid] and all its children (gunicorn
+    workers). RSS counts pages shared between them once per process,
+    PSS splits them, so PSS is the one to compare preload setups by."""
+    rss, pss, todo = 0, 0, [pid]
+    while todo:
+        p = todo.pop()
+        try:
+            with open("/proc/{}/smaps_rollup".format(p)) as f:
+                for line in f:
+                    field, value = line.split()[:2]
+                    if field == "Rss:":
+                        rss += int(value) * 1024
+                    elif field == "Pss:":
+                        pss += int(value) * 1024
+            for task in os.listdir("/proc/{}/task".format(p)):
+                with open("/proc/{}/task/{}/children".format(p, task)) as f:
+                    todo += [int(c) for c in f.read().split()]
+        except (OSError, ValueError):
+            pass
+    return {"rss_bytes": rss, "pss_bytes": pss}
+
+def run_case(url, case, requests, concurrency, encoding):
+    """Latency, throughput and size of [requests] sends of [case]."""
+    def one(_):
+        start = time.perf_counter()
+        status, nbytes = send(url, case, encoding)
+        return time.perf_counter() - start, status, nbytes
+
+    first = one(None)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+
+    ms = np.array([r[0] for r in results]) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"case": case["name"], "concurrency": concurrency, "requests": requests,
+            "errors": sum(r[1] >= 400 for r in results + [first]),
+            "first_ms": round(first[0] * 1000, 2), "p50_ms": round(p50, 2),
+            "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+            "mean_ms": round(ms.mean(), 2), "throughput_rps": round(requests / wall, 2),
+            "bytes": int(np.mean([r[2] for r in results]))}
+
+def bench_load(args):
+    import app
+    if args.url:
+        url = args.url.rstrip("/")
+        memory = (lambda: process_memory(args.pid)) if args.pid else dict
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, app.server, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_port)
+        memory = lambda: process_memory(os.getpid())
+
+    results = []
+    for case in load_cases(app):
+        if args.cases and not any(c in case["name"] for c in args.cases):
+            continue
+        for concurrency in args.concurrency:
+            r = run_case(url, case, args.requests, concurrency, args.encoding)
+            r.update(memory())
+            results.append(r)
+            print("{case:<42} c={concurrency:<3} p50 {p50_ms:>8.1f}ms  p95 {p95_ms:>8.1f}ms  "
+                "p99 {p99_ms:>8.1f}ms  {throughput_rps:>7.1f}/s  {bytes:>8}B".format(**r),
+                file=sys.stderr)
+    return results
+
+def timed(repeat, func):
+    """{"min_ms", "median_ms"} of [repeat] calls of [func]."""
+    ms = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        ms.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": round(min(ms), 3), "median_ms": round(float(np.median(ms)), 3),
+            "repeat": repeat}
+
+def bench_stages(args):
+    import tempfile
+    import plotly.utils
+    import gss_data
+    import pipeline
+
+    dataset = gss_data.GSSDataset()
+    results = {}
+    def record(name, func, **info):
+        results[name] = dict(timed(args.repeat, func), **info)
+        print("{:<32} {:>10.1f}ms".format(name, results[name]["median_ms"]), file=sys.stderr)
+
+    source = dataset.cumulative_source or dataset.source
+    record("read_gss", lambda: gss_data.read_gss(source))
+    raw = gss_data.read_gss(source)
+    record("clean_gss", lambda: gss_data.clean_gss(raw))
+    clean = gss_data.clean_gss(raw)
+    del raw
+    record("compact", lambda: gss_data.compact(clean))
+    frame, _ = gss_data.compact(clean)
+    with tempfile.TemporaryDirectory() as tmp:
+        def write():
+            path = os.path.join(tmp, "w{}".format(time.perf_counter_ns()))
+            gss_data.to_mmap(frame, path)
+        record("to_mmap", write)
+        gss_data.to_mmap(frame, os.path.join(tmp, "frame"))
+        record("open_mmap", lambda: gss_data.open_mmap(os.path.join(tmp, "frame")))
+
+    #each node is timed with everything upstream of it already memoized
+    graph = pipeline.gss_pipeline(dataset)
+    defaults = {"year": dataset.default_year, "fmt": "png", "column": "male_breadwinner"}
+    for name in graph.nodes:
+        params = {p: defaults[p] for p in graph._scope[name]}
+        value = graph.get(name, **params)
+        def compute():
+            graph.invalidate(name)
+            graph.get(name, **params)
+        record("node:" + name, compute)
+        if hasattr(value, "to_plotly_json"):
+            encode = lambda: json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder)
+            record("serialize:" + name, encode, bytes=len(encode()))
+    return results
+
+def compare(old, new):
+    """Lines of per-case change from result file [old] to [new]."""
+    if old["mode"] != new["mode"]:
+        raise SystemExit("can't compare a {} run with a {} run".format(old["mode"], new["mode"]))
+    if old["mode"] == "stages":
+        pairs = [(name, old["results"][name]["median_ms"], r["median_ms"])
+                for name, r in new["results"].items() if name in old["results"]]
+        head = "median"
+    else:
+        before = {(r["case"], r["concurrency"]): r["p50_ms"] for r in old["results"]}
+        after = {(r["case"], r["concurrency"]): r["p50_ms"] for r in new["results"]}
+        pairs = [("{} c={}".format(*key), before[key], p50)
+                for key, p50 in after.items() if key in before]
+        head = "p50"
+    lines = ["{:<42} {:>10} {:>10} {:>8}".format("", "old " + head, "new " + head, "change")]
+    for name, a, b in pairs:
+        change = "{:+.0%}".format(b / a - 1) if a else ""
+        lines.append("{:<42} {:>8.1f}ms {:>8.1f}ms {:>8}".format(name, a, b, change))
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    modes = parser.add_subparsers(dest="mode", required=True)
+    for mode in ("load", "stages"):
+        p = modes.add_parser(mode)
+        p.add_argument("--source", default=os.environ.get("GSS_SOURCE"),
+                    help="local GSS csv (default: $GSS_SOURCE)")
+        p.add_argument("--cumulative-source", default=os.environ.get("GSS_CUMULATIVE_SOURCE"),
+                    help="local cumulative GSS csv, for every year")
+        p.add_argument("--xgb-source",
+                    default=os.environ.get("XGB_CSV", os.path.join(repo_dir, "gss_xgboost_df.csv")),
+                    help="local feature importance csv (default: $XGB_CSV, else the repo's)")
+        p.add_argument("--out", help="write results here (default: stdout)")
+    load = modes.choices["load"]
+    load.add_argument("-c", "--concurrency", type=int, nargs="+", default=[1, 8])
+    load.add_argument("-n", "--requests", type=int, default=50, help="per case and concurrency")
+    load.add_argument("--cases", nargs="*", help="only cases whose name contains one of these")
+    load.add_argument("--encoding", default="gzip", help="Accept-Encoding to send")
+    load.add_argument("--url", help="benchmark a running server instead")
+    load.add_argument("--pid", type=int, help="process of --url to report memory for")
+    modes.choices["stages"].add_argument("--repeat", type=int, default=5)
+    diff = modes.add_parser("compare")
+    diff.add_argument("old")
+    diff.add_argument("new")
+    args = parser.parse_args()
+
+    if args.mode == "compare":
+        with open(args.old) as f, open(args.new) as g:
+            print("\n".join(compare(json.load(f), json.load(g))))
+        sys.exit()
+
+    for arg, env in [("source", "GSS_SOURCE"), ("cumulative_source", "GSS_CUMULATIVE_SOURCE"),
+            ("xgb_source", "XGB_CSV")]:
+        path = getattr(args, arg)
+        if path and not os.path.isfile(path):
+            parser.error("--{} must be a local file: {}".format(arg.replace("_", "-"), path))
+        if path:
+            #gss_data reads these when it is imported, before app is
+            os.environ[env] = path
+    if not args.source and not args.cumulative_source:
+        parser.error("give a local GSS csv with --source or $GSS_SOURCE")
+
+    run = {"mode": args.mode, "info": run_info(args)}
+    run["results"] = bench_load(args) if args.mode == "load" else bench_stages(args)
+    out = json.dumps(run, indent=1)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
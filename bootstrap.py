@@ -0,0 +1,201 @@
+"""Bootstrap confidence intervals for the sex income gap and the
+feature importances on the AI page.
+
+    python bootstrap.py [--reps 1000] [--years 2016 2018] [--unweighted]
+
+Each resample draws len(gss_clean) rows with replacement. Per resample
+it computes the male - female gap in (weighted) mean and median income
+and the importance share of every feature in a model trained like
+train_xgboost.py. Resamples run on a process pool. The input arrays are
+put in shared memory once and every worker maps them, so no task
+pickles the frame. A task is a chunk of resamples with its own seed,
+and the gap statistics for a whole chunk come from one grouped
+survey_stats call.
+
+Percentile intervals are written to gss_bootstrap.json, which the
+table and AI pages read for their error bars. An importance's estimate
+is its mean share over the resampled models, and the AI page draws the
+bar there rather than at gss_xgboost_df.csv's share, which comes from
+a different fit.
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from survey_stats import weighted_mean, weighted_median
+from profiling import stage
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+intervals_json = os.path.join(repo_dir, "gss_bootstrap.json")
+
+#resamples per task, enough to amortize the grouped statistics
+chunk_reps = 25
+
+def share(arrays):
+    """Copy {name: array} into shared memory blocks. Returns the blocks
+    (keep them alive, unlink when done) and the spec workers attach with."""
+    blocks, spec = [], {}
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        spec[name] = (shm.name, a.shape, a.dtype.str)
+    return blocks, spec
+
+#set in each worker by _attach
+_blocks = []
+_shared = {}
+
+def _attach(spec):
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _blocks.append(shm)
+        _shared[name] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+def gap_stats(income, female, weight, idx):
+    """(mean gap, median gap) per row of the resample index matrix [idx],
+    male minus female."""
+    reps, n = idx.shape
+    df = pd.DataFrame({"rep": np.repeat(np.arange(reps), n),
+                    "female": female[idx.ravel()], "income": income[idx.ravel()],
+                    "weight": weight[idx.ravel()]})
+    out = []
+    for stat in (weighted_mean, weighted_median):
+        s = stat(df, "income", by=["rep", "female"]).pivot(index="rep", columns="female", values="income")
+        out.append((s.get(0.0, np.nan) - s.get(1.0, np.nan)).reindex(range(reps)).to_numpy())
+    return np.column_stack(out)
+
+def importance_shares(X, y, w, idx, config):
+    """Total gain share (percent) of each column of [X] for a model fit
+    on every resample in [idx]."""
+    from train_xgboost import make_model
+    out = np.zeros((len(idx), X.shape[1]))
+    for r, rows in enumerate(idx):
+        model = make_model(1, config)
+        model.fit(X[rows], y[rows], sample_weight=w[rows])
+        gain = model.get_booster().get_score(importance_type="total_gain")
+        vals = np.array([gain.get("f{}".format(j), 0.0) for j in range(X.shape[1])])
+        out[r] = 100 * vals / vals.sum() if vals.sum() > 0 else vals
+    return out
+
+def _run_chunk(seed, reps, importances, config):
+    s = _shared
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(s["income"]), size=(reps, len(s["income"])))
+    gaps = gap_stats(s["income"], s["female"], s["weight"], idx)
+    if not importances:
+        return gaps, None
+    idx = rng.integers(0, len(s["y"]), size=(reps, len(s["y"])))
+    return gaps, importance_shares(s["X"], s["y"], s["xw"], idx, config)
+
+def interval(samples, level):
+    """(lo, hi) percentile interval of [samples] along axis 0."""
+    a = (1 - level) / 2
+    return np.nanquantile(samples, [a, 1 - a], axis=0)
+
+def bootstrap(gss_clean, reps=1000, weighted=True, importances=True,
+            level=0.95, seed=0, workers=None):
+    """Intervals for one survey year: {"gap": {"mean": {...}, "median":
+    {...}}, "importance": {feature: {...}}}, each with the full-sample
+    estimate and lo/hi at [level]."""
+    from train_xgboost import feature_matrix, train_config
+
+    df = gss_clean[gss_clean.income.notna() & gss_clean.sex.notna()]
+    weight = df.weight.to_numpy(dtype=float) if weighted else np.ones(len(df))
+    arrays = {"income": df.income.to_numpy(dtype=float),
+            "female": (df.sex == "female").to_numpy(dtype=float),
+            "weight": np.nan_to_num(weight)}
+    features = []
+    if importances:
+        X, y, xw = feature_matrix(gss_clean)
+        features = list(X.columns)
+        arrays.update(X=X.to_numpy(dtype=np.float32), y=y,
+                    xw=xw if weighted else np.ones(len(y)))
+
+    blocks, spec = share(arrays)
+    seeds = np.random.SeedSequence(seed).generate_state(-(-reps // chunk_reps))
+    sizes = [min(chunk_reps, reps - i * chunk_reps) for i in range(len(seeds))]
+    try:
+        with stage("bootstrap", reps=reps, rows=len(df)), \
+                ProcessPoolExecutor(workers, initializer=_attach, initargs=(spec,)) as pool:
+            results = list(pool.map(_run_chunk, seeds, sizes,
+                            [importances] * len(sizes), [train_config] * len(sizes)))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    gaps = np.vstack([g for g, _ in results])
+    estimate = gap_stats(arrays["income"], arrays["female"], arrays["weight"],
+                        np.arange(len(df))[None, :])[0]
+    lo, hi = interval(gaps, level)
+    out = {"gap": {stat: {"estimate": float(estimate[i]), "lo": float(lo[i]), "hi": float(hi[i])}
+                    for i, stat in enumerate(["mean", "median"])}}
+    if importances:
+        shares = np.vstack([imp for _, imp in results])
+        est = shares.mean(axis=0)
+        lo, hi = interval(shares, level)
+        out["importance"] = {f: {"estimate": float(est[j]), "lo": float(lo[j]), "hi": float(hi[j])}
+                            for j, f in enumerate(features)}
+    return out
+
+def save(result, path=intervals_json):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(result, f, indent=1)
+    os.replace(tmp, path)
+
+_loaded = {}
+
+def load_intervals(path=intervals_json):
+    """Saved intervals, {} when bootstrap.py has not been run. Re-read
+    when the file changes."""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    if _loaded.get(path, (None,))[0] != mtime:
+        with open(path) as f:
+            _loaded[path] = (mtime, json.load(f))
+    return _loaded[path][1]
+
+def year_intervals(year, path=intervals_json):
+    """Intervals for survey [year], {} when there are none."""
+    return load_intervals(path).get("years", {}).get(str(year), {})
+
+def importance_intervals(path=intervals_json):
+    """Importance intervals of the latest year with any, {} if none."""
+    years = load_intervals(path).get("years", {})
+    for year in sorted(years, reverse=True):
+        if years[year].get("importance"):
+            return years[year]["importance"]
+    return {}
+
+if __name__ == '__main__':
+    from gss_data import GSSDataset
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reps", type=int, default=1000, help="resamples (default: %(default)s)")
+    parser.add_argument("--years", type=int, nargs="*", help="survey years (default: latest)")
+    parser.add_argument("--unweighted", action="store_true", help="ignore the survey weights")
+    parser.add_argument("--no-importances", action="store_true", help="only the income gaps")
+    parser.add_argument("--level", type=float, default=0.95)
+    parser.add_argument("--workers", type=int, help="processes (default: all cores)")
+    parser.add_argument("--out", default=intervals_json)
+    args = parser.parse_args()
+
+    dataset = GSSDataset()
+    result = {"reps": args.reps, "level": args.level,
+            "weighted": not args.unweighted, "years": {}}
+    for year in args.years or [dataset.default_year]:
+        start = time.time()
+        result["years"][str(year)] = bootstrap(dataset.load(year), args.reps,
+                weighted=not args.unweighted, importances=not args.no_importances,
+                level=args.level, workers=args.workers)
+        print("{}: {} resamples in {:.1f}s".format(year, args.reps, time.time() - start))
+    save(result, args.out)
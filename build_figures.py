@@ -0,0 +1,32 @@
+"""Render every page's figure to the artifact store.
+
+    python build_figures.py [--out DIR]
+
+Once the store exists app.py serves the stored figures and never
+imports plotly.express, statsmodels or matplotlib.
+"""
+import argparse
+import time
+import artifacts
+import figures
+from gss_data import GSSDataset, xgb_csv
+
+def build(out=artifacts.artifact_dir):
+    #artifacts are for the default (latest) survey year
+    dataset = GSSDataset()
+    xgb_source = xgb_csv()
+    version = artifacts.build_version(dataset.cumulative_source or dataset.source, xgb_source)
+    figs, images = figures.build_all(dataset.load(), xgb_source)
+    return artifacts.save_all(figs, images, out, version)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default=artifacts.artifact_dir,
+                        help="artifact directory (default: %(default)s)")
+    args = parser.parse_args()
+
+    start = time.time()
+    manifest = build(args.out)
+    print("wrote {} figures and {} images to {} in {:.1f}s".format(
+        len(manifest["figures"]), len(manifest["images"]),
+        args.out, time.time() - start))
@@ -0,0 +1,23 @@
+"""Callback requests as a browser sends them on first load, for
+benchmark.py to time and snapshot.py to render pages from.
+"""
+
+def callback_body(output, inputs, values):
+    """_dash-update-component body for the callback with key [output]
+    in app.callback_map and [inputs] [(id, property)], with the values
+    in [values] {(id, property): value} and None for the rest."""
+    outs = [o.rsplit(".", 1) for o in output.strip(".").split("...")]
+    outs = [{"id": i, "property": p} for i, p in outs]
+    return {"output": output,
+            "outputs": outs if output.startswith("..") else outs[0],
+            "inputs": [{"id": i, "property": p, "value": values.get((i, p))}
+                    for i, p in inputs],
+            "changedPropIds": []}
+
+def first_load_values(app):
+    """{(id, property): value} of the inputs a browser sends on first
+    load of the app module [app], besides the url."""
+    store = app.shap_store.open_store()
+    return {("year", "value"): app.dataset.default_year,
+            ("filter-age", "value"): app.age_range,
+            ("respondent-id", "value"): int(store.ids[0]) if store is not None else None}
@@ -0,0 +1,313 @@
+import numpy as np
+import pandas as pd
+from gss_data import colorder, cat_order, satjob_order
+
+#binned dimensions; every dimension also gets a trailing "missing" slot
+age_edges = list(range(15, 95, 5))
+educ_bands = ["Less than High School", "High School", "Some College",
+            "Bachelor's", "Graduate"]
+educ_edges = [-np.inf, 11.5, 12.5, 15.5, 16.5, np.inf]
+prest_groups = list(range(1, 7))
+
+measures = ['income', 'job_prestige', 'socioeconomic_index', 'education']
+
+#answers of each Likert column the cube tabulates, in order
+likert = {**{c: cat_order for c in colorder}, "satjob": satjob_order}
+
+#columns every cube reads besides its measures and Likert columns
+base_columns = ["sex", "region", "age", "education", "job_prestige", "weight"]
+
+def _codes(values, n):
+    """Integer codes with missing values (-1 / NaN) moved to slot [n]."""
+    codes = np.asarray(values)
+    codes = np.where((codes < 0) | pd.isna(codes), n, codes)
+    return codes.astype(np.intp)
+
+class GSSCube:
+    """Sufficient statistics of a cleaned GSS frame over its categorical
+    dimensions (sex, region, age band, education band, job prestige
+    group), so filtered aggregates are a sum over a few small arrays
+    instead of a scan of the frame.
+
+    Per cell the cube keeps counts and weight totals, plain and weighted
+    sums of each of [measures], and, if income is among them, an income
+    histogram over equal-count bins which serves as the sketch for
+    medians and quartiles. The answers to every column in [likert] get
+    the same base cell with the answer added as an extra dimension, see
+    crosstab(). A cube of no measures and one Likert column needs only
+    [base_columns] and that column, and serves counts() and crosstab().
+
+    Only occupied cells are stored, with their coordinates in [coords]:
+    a year has a few thousand respondents against tens of thousands of
+    cells in the full grid. Coordinates are int16, counts int32 and sums
+    float32, rollups add them up in float64.
+    """
+    dims = ("sex", "region", "age", "education", "prestige")
+
+    def __init__(self, gss_clean, sketch_bins=64, measures=measures, likert=likert):
+        df = gss_clean
+        self.labels = {"sex": list(df.sex.cat.categories),
+                    "region": sorted(df.region.dropna().unique()),
+                    "age": ["{}-{}".format(a, a + 4) for a in age_edges[:-1]],
+                    "education": educ_bands,
+                    "prestige": prest_groups}
+
+        #same 6 equal width groups as pd.cut() in the prestige levels figure
+        prest, self.prest_edges = pd.cut(df.job_prestige, 6,
+                                    labels=False, retbins=True)
+        region = pd.Categorical(df.region, categories=self.labels["region"])
+        codes = [_codes(df.sex.cat.codes, len(self.labels["sex"])),
+                _codes(region.codes, len(self.labels["region"])),
+                _codes(pd.cut(df.age, age_edges, right=False, labels=False),
+                        len(self.labels["age"])),
+                _codes(pd.cut(df.education, educ_edges, labels=False),
+                        len(educ_bands)),
+                _codes(prest, len(prest_groups))]
+        self.shape = tuple(len(self.labels[d]) + 1 for d in self.dims)
+        cells, cell = np.unique(np.ravel_multi_index(codes, self.shape),
+                            return_inverse=True)
+        self.coords = np.array(np.unravel_index(cells, self.shape), dtype=np.int16)
+
+        weight = df.weight.fillna(0).to_numpy(dtype=float)
+
+        def cube(w=None, idx=cell, extra=(), dtype=np.float32):
+            #[idx] numbers occupied cells, times the size of [extra] if any
+            shape = (len(cells),) + extra
+            return np.bincount(idx, weights=w,
+                            minlength=int(np.prod(shape))).reshape(shape).astype(dtype)
+
+        self.n = cube(dtype=np.int32)
+        self.w = cube(weight)
+        self.measures = list(measures)
+        self.stats = {}
+        for m in self.measures:
+            vals = df[m].to_numpy(dtype=float)
+            ok = ~np.isnan(vals)
+            v = np.where(ok, vals, 0)
+            self.stats[m] = {"n": cube(ok.astype(float), dtype=np.int32),
+                            "sum": cube(v),
+                            "w": cube(ok * weight),
+                            "wsum": cube(v * weight)}
+
+        #income sketch: histogram over equal-count bins of this frame's
+        #income, or, when there are no more values than bins (coninc is a
+        #few dozen category midpoints a year), over the values themselves
+        self.income_edges = None
+        self.income_exact = False
+        if "income" in self.measures:
+            income = df.income.to_numpy(dtype=float)
+            ok = ~np.isnan(income)
+            values = np.unique(income[ok])
+            self.income_exact = len(values) <= sketch_bins
+            if self.income_exact:
+                self.income_edges = values
+                nbins = len(values)
+                hbin = np.searchsorted(values, income[ok])
+            else:
+                self.income_edges = np.unique(np.quantile(income[ok],
+                                            np.linspace(0, 1, sketch_bins + 1)))
+                nbins = len(self.income_edges) - 1
+                hbin = np.clip(np.searchsorted(self.income_edges, income[ok],
+                                            side="right") - 1, 0, nbins - 1)
+            hidx = cell[ok] * nbins + hbin
+            self.income_whist = cube(weight[ok], hidx, (nbins,))
+            #the unweighted histogram is only built if something asks for it
+            self._hist_idx = hidx.astype(np.int32)
+            self._hist_shape = (len(cells), nbins)
+            self._income_hist = None
+
+        #every Likert column's answers (and a missing slot) side by side on
+        #one extra dimension, all tabulated by one bincount of stacked codes
+        self.likert = dict(likert)
+        self.answer_slots = {}
+        start = 0
+        for c, answers in likert.items():
+            self.answer_slots[c] = slice(start, start + len(answers) + 1)
+            start += len(answers) + 1
+        aidx = np.concatenate([cell * start + self.answer_slots[c].start +
+                    _codes(pd.Categorical(df[c], categories=answers).codes, len(answers))
+                    for c, answers in likert.items()])
+        self.answers = {"n": cube(None, aidx, (start,), np.int32),
+                        "w": cube(np.tile(weight, len(likert)), aidx, (start,))}
+
+    @property
+    def income_hist(self):
+        if self._income_hist is None:
+            self._income_hist = np.bincount(self._hist_idx,
+                    minlength=int(np.prod(self._hist_shape))
+                    ).reshape(self._hist_shape).astype(np.int32)
+        return self._income_hist
+
+    def _select(self, region=None, education=None, age=None):
+        """Index arrays for each base dimension from dashboard filters.
+        [region] and [education] are lists of labels, [age] is (lo, hi)
+        in years, lo inclusive and hi exclusive. Unfiltered dimensions
+        keep their missing slot."""
+        def pick(dim, chosen):
+            if not chosen:
+                return np.arange(self.shape[self.dims.index(dim)])
+            return np.array([self.labels[dim].index(x) for x in chosen
+                            if x in self.labels[dim]], dtype=np.intp)
+
+        ages = None
+        if age is not None:
+            lo, hi = age
+            ages = [lab for a, lab in zip(age_edges, self.labels["age"])
+                    if a >= lo and a + 5 <= hi]
+        return [np.arange(self.shape[0]),
+                pick("region", region),
+                pick("age", ages) if age is not None else np.arange(self.shape[2]),
+                pick("education", education),
+                np.arange(self.shape[4])]
+
+    def _order(self, by):
+        return tuple(d for d in self.dims if d in by)
+
+    def _rollup(self, arr, select, by):
+        """Sum per-cell [arr] over the selected cells into a dense array
+        over dimensions [by], indexed by position in their selection."""
+        keep = np.ones(len(arr), dtype=bool)
+        groups, gshape = [], []
+        for axis, (d, picked) in enumerate(zip(self.dims, select)):
+            #position of each cell's coordinate in the selection, -1 if left out
+            where = np.full(self.shape[axis], -1, dtype=np.intp)
+            where[picked] = np.arange(len(picked))
+            pos = where[self.coords[axis]]
+            if len(picked) != self.shape[axis]:
+                keep &= pos >= 0
+            if d in by:
+                groups.append(pos)
+                gshape.append(len(picked))
+        flat = arr[keep].reshape(int(keep.sum()), -1)
+        group = np.ravel_multi_index([g[keep] for g in groups], gshape) if by \
+                else np.zeros(len(flat), dtype=np.intp)
+        #one bincount for every (group, trailing slot) pair
+        slots = flat.shape[1]
+        idx = (group[:, None] * slots + np.arange(slots)).ravel()
+        out = np.bincount(idx, weights=flat.ravel().astype(float),
+                        minlength=int(np.prod(gshape)) * slots)
+        out = out.reshape(tuple(gshape) + arr.shape[1:])
+        return out.astype(np.int64) if arr.dtype.kind == "i" else out
+
+    def means(self, by=("sex",), weighted=False, **filters):
+        """Mean of each of [measures] per [by] group."""
+        by = self._order(by)
+        sel = self._select(**filters)
+        n_key, s_key = ("w", "wsum") if weighted else ("n", "sum")
+        out = {}
+        for m in self.measures:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[m] = (self._rollup(self.stats[m][s_key], sel, by) /
+                        self._rollup(self.stats[m][n_key], sel, by))
+        return self._frame(out, by)
+
+    def counts(self, column, weighted=False, **filters):
+        """Counts of each answer to Likert [column] by sex."""
+        sel = self._select(**filters)
+        arr = self.answers["w" if weighted else "n"]
+        tab = self._rollup(arr, sel, ("sex",))[:-1, self.answer_slots[column]][:, :-1]
+        return pd.DataFrame(tab, index=self.labels["sex"], columns=self.likert[column])
+
+    def crosstab(self, columns=None, by=("sex",), weighted=True, **filters):
+        """Counts of each answer to the Likert [columns] (default: all)
+        per [by] group, and each answer's share of its group's answers
+        to that column: long frame of column, [by], answer, count, share.
+        Missing answers and groups count towards neither."""
+        by = self._order(by)
+        sel = self._select(**filters)
+        tab = self._rollup(self.answers["w" if weighted else "n"], sel, by)
+        #selected slots of each [by] dim, without its missing slot
+        picked = [sel[self.dims.index(d)] for d in by]
+        keep = [np.flatnonzero(p < len(self.labels[d])) for d, p in zip(by, picked)]
+        tab = tab[np.ix_(*keep, np.arange(tab.shape[-1]))]
+        groups = [[self.labels[d][i] for i in p[k]] for d, p, k in zip(by, picked, keep)]
+
+        out = {k: [] for k in ["column", *by, "answer", "count", "share"]}
+        for c in columns or self.likert:
+            t = tab[..., self.answer_slots[c]][..., :-1]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                share = t / t.sum(axis=-1, keepdims=True)
+            cells = np.unravel_index(np.arange(t.size), t.shape)
+            for d, labels, pos in zip(by, groups, cells):
+                out[d].append(np.asarray(labels, dtype=object)[pos])
+            out["answer"].append(np.asarray(self.likert[c], dtype=object)[cells[-1]])
+            out["column"].append(np.full(t.size, c, dtype=object))
+            out["count"].append(t.ravel())
+            out["share"].append(share.ravel())
+        return pd.DataFrame({k: np.concatenate(v) for k, v in out.items()})
+
+    def quantiles(self, q=(0.25, 0.5, 0.75), by=("sex",), weighted=False, **filters):
+        """Income quantiles per [by] group read off the histogram sketch.
+        With income_exact each bin holds one value and its observations,
+        placed like survey_stats.weighted_quantile() places them (each at
+        the middle of its weight, here the bin's mean weight), so
+        quantiles match it: exactly when unweighted. Otherwise they are
+        interpolated linearly inside a bin, an approximation."""
+        by = self._order(by)
+        sel = self._select(**filters)
+        hist = self._rollup(self.income_whist if weighted else self.income_hist, sel, by)
+        cum = np.cumsum(hist, axis=-1)
+        total = cum[..., -1:]
+        edges = self.income_edges
+        last = hist.shape[-1] - 1
+        if self.income_exact:
+            counts = self._rollup(self.income_hist, sel, by) if weighted else hist
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean_w = np.where(counts > 0, hist / counts, 0)
+            #nearest occupied bin at or before / at or after each bin
+            slots = np.arange(hist.shape[-1])
+            prev = np.maximum.accumulate(np.where(counts > 0, slots, -1), axis=-1)
+            nxt = np.minimum.accumulate(np.where(counts > 0, slots, last + 1)[..., ::-1],
+                                        axis=-1)[..., ::-1]
+        take = lambda a, i: np.take_along_axis(a, i, -1)
+        out = {}
+        for qq in q:
+            #a tiny floor makes q=0 land on the first occupied bin
+            target = np.maximum(qq * total, 1e-9)
+            b = np.minimum((cum < target).sum(axis=-1, keepdims=True), last)
+            inbin = take(hist, b)
+            before = take(cum, b) - inbin
+            if self.income_exact:
+                #between the middles of a bin's first and last observation
+                #the value is the bin's, outside it runs to the neighbour's
+                wb = take(mean_w, b)
+                lo, hi = before + wb / 2, take(cum, b) - wb / 2
+                p = take(prev, np.maximum(b - 1, 0))
+                n = take(nxt, np.minimum(b + 1, last))
+                p_ok, n_ok = (b > 0) & (p >= 0), (b < last) & (n <= last)
+                p, n = np.maximum(p, 0), np.minimum(n, last)
+                p_mid = take(cum, p) - take(mean_w, p) / 2
+                n_mid = take(cum, b) + take(mean_w, n) / 2
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    down = edges[p] + (target - p_mid) / (lo - p_mid) * (edges[b] - edges[p])
+                    up = edges[b] + (target - hi) / (n_mid - hi) * (edges[n] - edges[b])
+                val = np.where(p_ok & (target < lo), down,
+                            np.where(n_ok & (target > hi), up, edges[b]))
+            else:
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    frac = np.where(inbin > 0, (target - before) / inbin, 0)
+                val = edges[b] + frac * (edges[b + 1] - edges[b])
+            out[qq] = np.where(total > 0, val, np.nan)[..., 0]
+        return self._frame(out, by)
+
+    def box_stats(self, by=("sex",), weighted=False, **filters):
+        """Quartiles and 1.5*IQR fences of income per [by] group, fences
+        clipped to the lowest and highest occupied sketch bins."""
+        qs = self.quantiles((0, 0.25, 0.5, 0.75, 1), by, weighted, **filters)
+        iqr = qs[0.75] - qs[0.25]
+        return pd.DataFrame({**{d: qs[d] for d in self._order(by)},
+                "q1": qs[0.25], "median": qs[0.5], "q3": qs[0.75],
+                "lowerfence": np.maximum(qs[0], qs[0.25] - 1.5 * iqr),
+                "upperfence": np.minimum(qs[1], qs[0.75] + 1.5 * iqr)})
+
+    def _frame(self, out, by):
+        """Long frame of {name: array over [by] dims}, missing slots dropped."""
+        trim = tuple(slice(0, -1) for _ in by)
+        index = pd.MultiIndex.from_product([self.labels[d] for d in by], names=list(by))
+        return pd.DataFrame({k: v[trim].ravel() for k, v in out.items()},
+                            index=index).reset_index()
+
+def crosstab_years(cubes, columns=None, by=("sex",), weighted=True, **filters):
+    """GSSCube.crosstab() of each {year: cube} in [cubes], with a year column."""
+    return pd.concat([c.crosstab(columns, by, weighted, **filters).assign(year=year)
+                    for year, c in cubes.items()], ignore_index=True)
@@ -0,0 +1,171 @@
+"""Filtered rows of the cleaned GSS data as a streamed download.
+
+    /export/gss.csv?year=2018&sex=female&region=pacific&age=30-60
+    /export/gss.arrow?year=all&male_breadwinner=agree&job_prestige=40-80
+
+Filters are the dashboard's and a few more:
+- year: repeat it for several years, or use "all". Default: the latest.
+- sex, region, satjob and the belief columns: repeat a column for
+  several values.
+- education_band: the dashboard's education bands.
+- age, job_prestige, education and income: lo-hi ranges, read as
+  lo <= value < hi like the dashboard's age slider. Either end may be
+  left out.
+
+Rows are read one batch at a time (GSSDataset.iter_batches), filtered,
+and written out as CSV text or as Arrow IPC stream record batches. A
+download of every year only ever holds one batch in memory. Responses
+are gzipped when the client accepts it.
+"""
+import os
+import zlib
+import numpy as np
+import pandas as pd
+from flask import Response, abort, request
+from gss_data import mycols, rename_cols, colorder
+import cube
+
+columns = ["year"] + [rename_cols.get(c, c) for c in mycols]
+choice_filters = ["sex", "region", "satjob"] + colorder
+range_filters = ["age", "job_prestige", "education", "income"]
+mimetypes = {"csv": "text/csv", "arrow": "application/vnd.apache.arrow.stream"}
+
+#rows read, filtered and written at a time
+batch_rows = int(os.environ.get("EXPORT_BATCH_ROWS", 10000))
+
+def parse_filters(args, years):
+    """(years, {column: values}, {column: (lo, hi)}, education bands)
+    from the query [args], ValueError for anything it doesn't know."""
+    unknown = set(args) - set(choice_filters) - set(range_filters) - {"year", "education_band"}
+    if unknown:
+        raise ValueError("unknown filter {}".format(", ".join(sorted(unknown))))
+
+    asked = args.getlist("year")
+    if not asked:
+        chosen = [years[-1]]
+    elif "all" in asked:
+        chosen = list(years)
+    else:
+        try:
+            chosen = sorted({int(y) for y in asked})
+        except ValueError:
+            raise ValueError("year must be a number or all")
+        missing = [y for y in chosen if y not in years]
+        if missing:
+            raise ValueError("no GSS data for year {}".format(missing[0]))
+
+    choices = {c: args.getlist(c) for c in choice_filters if c in args}
+    ranges = {}
+    for c in range_filters:
+        if c in args:
+            lo, sep, hi = args[c].partition("-")
+            try:
+                ranges[c] = (float(lo) if lo else -np.inf, float(hi) if hi else np.inf)
+            except ValueError:
+                sep = ""
+            if not sep:
+                raise ValueError("{} must be a lo-hi range".format(c))
+    bands = args.getlist("education_band")
+    if set(bands) - set(cube.educ_bands):
+        raise ValueError("education_band must be one of {}".format(", ".join(cube.educ_bands)))
+    return chosen, choices, ranges, bands
+
+def row_mask(batch, choices, ranges, bands):
+    """Rows of [batch] that pass every filter; missing values never do."""
+    ok = np.ones(len(batch), dtype=bool)
+    for c, values in choices.items():
+        ok &= batch[c].isin(values).to_numpy()
+    for c, (lo, hi) in ranges.items():
+        x = batch[c].to_numpy(dtype=float)
+        with np.errstate(invalid="ignore"):
+            ok &= (x >= lo) & (x < hi)
+    if bands:
+        band = pd.cut(batch.education, cube.educ_edges, labels=cube.educ_bands)
+        ok &= band.isin(bands).to_numpy()
+    return ok
+
+def arrow_schema():
+    import pyarrow as pa
+    def field(c):
+        if c in ("year", "id"):
+            return pa.field(c, pa.int64())
+        if c in choice_filters:
+            return pa.field(c, pa.dictionary(pa.int8(), pa.string()))
+        return pa.field(c, pa.float64())
+    return pa.schema([field(c) for c in columns])
+
+class _Chunks:
+    #file-like sink for the Arrow writer, emptied after every batch
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        out, self.parts = b"".join(self.parts), []
+        return out
+
+def stream(dataset, fmt, years, choices, ranges, bands, gzip=False):
+    """Generator of the response body: the rows of [years] that pass the
+    filters, as [fmt] ("csv" or "arrow"), gzipped if [gzip]."""
+    packer = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    def out(data):
+        return packer.compress(data) if packer else data
+
+    if fmt == "arrow":
+        import pyarrow as pa
+        schema = arrow_schema()
+        sink = _Chunks()
+        writer = pa.ipc.new_stream(sink, schema)
+        yield out(sink.take())
+    else:
+        yield out((",".join(columns) + "\n").encode("utf-8"))
+
+    for year in years:
+        for batch in dataset.iter_batches(year, batch_rows):
+            rows = batch[row_mask(batch, choices, ranges, bands)]
+            if rows.empty:
+                continue
+            rows = rows.assign(year=year)[columns]
+            if fmt == "arrow":
+                #ordered and unordered categoricals alike go out as plain dictionaries
+                rows = rows.astype({c: object for c in choice_filters})
+                writer.write_batch(pa.RecordBatch.from_pandas(rows, schema=schema,
+                                    preserve_index=False))
+                yield out(sink.take())
+            else:
+                yield out(rows.to_csv(index=False, header=False).encode("utf-8"))
+
+    if fmt == "arrow":
+        writer.close()
+        yield out(sink.take())
+    if packer:
+        yield packer.flush()
+
+def install(server, dataset, path="/export"):
+    """Serve filtered rows of [dataset] (a GSSDataset) from the Flask
+    [server] at [path]/gss.csv and [path]/gss.arrow."""
+
+    @server.route(path + "/gss.<fmt>")
+    def export_rows(fmt):
+        if fmt not in mimetypes:
+            abort(404)
+        try:
+            years, choices, ranges, bands = parse_filters(request.args, dataset.years())
+        except ValueError as e:
+            abort(400, str(e))
+        gzip = bool(request.accept_encodings["gzip"])
+        resp = Response(stream(dataset, fmt, years, choices, ranges, bands, gzip),
+                        mimetype=mimetypes[fmt])
+        resp.headers["Content-Disposition"] = 'attachment; filename="gss.{}"'.format(fmt)
+        resp.headers["Vary"] = "Accept-Encoding"
+        if gzip:
+            resp.headers["Content-Encoding"] = "gzip"
+        return resp
@@ -0,0 +1,429 @@
+import os
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.express as px
+from survey_stats import weighted_mean, weighted_quantile, group_codes
+from trendline import add_trendlines
+from profiling import stage
+from gss_data import expand, xgb_csv, belief_questions, belief_default
+from cube import GSSCube
+
+#the violin page sends at most this many sampled points, with only these hover columns
+violin_sample_n = int(os.environ.get("VIOLIN_SAMPLE_N", 500))
+violin_hover_cols = ['age', 'education', 'job_prestige', 'socioeconomic_index']
+
+#the prestige page draws points with WebGL above gl_rows of them and a
+#binned density per sex instead of points above density_rows
+prestige_gl_rows = int(os.environ.get("PRESTIGE_GL_ROWS", 1000))
+prestige_density_rows = int(os.environ.get("PRESTIGE_DENSITY_ROWS", 5000))
+prestige_bins = 40
+prestige_hover_cols = ['education', 'socioeconomic_index']
+
+#box plots send their statistics and at most this many outliers per box
+box_max_outliers = int(os.environ.get("BOX_MAX_OUTLIERS", 50))
+
+table_cols = ["income", "job_prestige", "socioeconomic_index", "education"]
+
+def table_means(gss_clean):
+    """Survey-weighted means of table_cols by sex."""
+    sexes = gss_clean.sex.cat.categories
+    gss_grp = pd.DataFrame({"sex": sexes})
+    for c in table_cols:
+        gss_grp[c] = weighted_mean(gss_clean, c, by="sex").set_index("sex")[c].reindex(sexes).to_numpy()
+    return gss_grp
+
+def make_table(gss_clean):
+    """Summary table of survey-weighted mean values by sex."""
+    return table_figure(table_means(gss_clean))
+
+def table_figure(gss_grp):
+    """Summary table from a frame of means with a sex column."""
+    #figure_factory pulls in scipy when it is installed, only load it here
+    import plotly.figure_factory as ff
+
+    gss_grp = round(gss_grp[["sex"] + table_cols],2)
+    gss_grp.columns = [x.replace("_", " ").title() \
+                    for x in list(gss_grp.columns)]
+
+    return ff.create_table(gss_grp)
+
+def roles_counts(gss_clean):
+    """Sex / Male Breadwinner / Count rows."""
+    bread = gss_clean[["sex", "male_breadwinner"]]
+    bread = bread.value_counts().reset_index()
+    bread.columns = ["Sex", "Male Breadwinner", "Count"]
+    return bread
+
+def make_roles(gss_clean):
+    """Grouped bar chart of male_breadwinner agreement by sex."""
+    return roles_figure(roles_counts(gss_clean))
+
+def roles_figure(bread):
+    """Grouped bar chart from Sex / Male Breadwinner / Count rows."""
+    fig1 = px.bar(bread, x="Male Breadwinner", y="Count", color='Sex',
+                labels={'Count':'Count Of Response Selection',
+                'Male Breadwinner':'Agreement levels to: <br>"It is much better for everyone involved <br>if the man is the achiever outside the home <br>and the woman takes care of the home and family."'},
+                barmode = 'group')
+    fig1.update_layout(showlegend=True)
+    fig1.update(layout=dict(title=dict(x=0.5)))
+    return fig1
+
+def beliefs_figure(tab, column, split=None):
+    """Grouped bars of each answer's weighted share by sex from the
+    GSSCube.crosstab() rows [tab] of [column], one facet per value of
+    [split] ("region" or "year") if given."""
+    import textwrap
+    tab = tab[tab.column == column]
+    facets = tab[split].nunique() if split else 1
+    fig = px.bar(tab, x="answer", y="share", color="sex", barmode="group",
+                facet_col=split, facet_col_wrap=3 if split else 0,
+                hover_data={"count": ":,.0f", "share": ":.1%"},
+                category_orders={"answer": list(pd.unique(tab.answer))},
+                labels={"share": "Share of answers", "answer": "", "sex": "Sex"},
+                height=max(450, 250 * -(-facets // 3)))
+    fig.update_yaxes(tickformat=".0%")
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+    fig.update_layout(title=dict(x=0.5,
+            text="<br>".join(textwrap.wrap(belief_questions[column], 70))))
+    return fig
+
+def default_beliefs_figure(gss_cube):
+    """The beliefs page's first view, belief_default by sex with no
+    filters, from a GSSCube."""
+    return beliefs_figure(gss_cube.crosstab([belief_default]), belief_default)
+
+def make_beliefs(gss_clean):
+    """The beliefs page's first view, see default_beliefs_figure()."""
+    return default_beliefs_figure(GSSCube(gss_clean))
+
+def prestige_points(gss_clean):
+    """Respondents with a job prestige, income and sex, and the columns
+    the prestige page shows for them."""
+    return expand(gss_clean[['job_prestige', 'income', 'sex', 'weight'] + prestige_hover_cols]
+                ).dropna(subset=['job_prestige', 'income', 'sex'])
+
+def density_traces(points, x_range, y_range, colors, bins=prestige_bins):
+    """One heatmap of respondent counts per sex on a [bins] x [bins]
+    grid over [x_range] x [y_range], transparent where a sex has none."""
+    traces = []
+    for sex, color in colors.items():
+        pts = points[points.sex == sex]
+        counts, xedges, yedges = np.histogram2d(pts.job_prestige, pts.income,
+                                    bins=bins, range=[x_range, y_range])
+        traces.append(go.Heatmap(
+            x=(xedges[:-1] + xedges[1:]) / 2, y=(yedges[:-1] + yedges[1:]) / 2,
+            z=np.where(counts > 0, counts, np.nan).T,
+            colorscale=[[0, "rgba(0,0,0,0)"], [1, color]], zmin=0,
+            opacity=0.6, showscale=False, name=sex,
+            hovertemplate="sex=" + sex + "<br>job_prestige=%{x:.0f}<br>income=%{y:,.0f}"
+                "<br>respondents=%{z}<extra></extra>"))
+    return traces
+
+def prestige_figure(points, x_range=None, y_range=None,
+                    gl_rows=None, density_rows=None):
+    """Job prestige vs income per sex with a survey-weighted trendline
+    and 95% band, over [x_range] x [y_range] (default: all of
+    [points]). The points in view are drawn as they are, with WebGL
+    when there are more than [gl_rows], or as a binned density when
+    there are more than [density_rows], so the figure stays the same
+    size however many respondents there are."""
+    gl_rows = prestige_gl_rows if gl_rows is None else gl_rows
+    density_rows = prestige_density_rows if density_rows is None else density_rows
+    palette = px.colors.qualitative.Plotly
+    colors = {sex: palette[i % len(palette)] for i, sex in enumerate(points.sex.cat.categories)}
+
+    visible = points
+    if x_range is not None:
+        visible = visible[visible.job_prestige.between(*x_range)]
+    if y_range is not None:
+        visible = visible[visible.income.between(*y_range)]
+
+    labels = {'job_prestige':'Job Prestige', 'income':'Income'}
+    if len(visible) > density_rows:
+        fig = go.Figure(density_traces(visible,
+                x_range or (points.job_prestige.min(), points.job_prestige.max()),
+                y_range or (points.income.min(), points.income.max()), colors))
+        fig.update_layout(xaxis_title=labels['job_prestige'], yaxis_title=labels['income'],
+                        legend_title_text='sex')
+    else:
+        fig = px.scatter(visible, x='job_prestige', y='income',
+                        color = 'sex', color_discrete_map=colors,
+                        #height=600, width=600,
+                        labels=labels, hover_data=prestige_hover_cols,
+                        render_mode="webgl" if len(visible) > gl_rows else "svg")
+    #closed form fit instead of trendline='ols', which needs statsmodels;
+    #always fit on every point, not just the ones in view
+    add_trendlines(fig, points, 'job_prestige', 'income', 'sex',
+                weight='weight', ci=0.95, colors=colors)
+    if x_range is not None:
+        fig.update_xaxes(range=list(x_range))
+    if y_range is not None:
+        fig.update_yaxes(range=list(y_range))
+    fig.update(layout=dict(title=dict(x=0.5)))
+    return fig
+
+def make_prestige(gss_clean):
+    """Job prestige vs income for every respondent, see prestige_figure()."""
+    return prestige_figure(prestige_points(gss_clean))
+
+def box_summary(df, value, by, weight="weight", max_outliers=None):
+    """Quartiles, whisker ends (the furthest points within 1.5*IQR) and
+    outliers of [value] per [by] group, in one sorted pass over all
+    groups. Quartiles are weighted by the [weight] column, like the
+    filtered charts' GSSCube.box_stats(weighted=True). A group keeps at
+    most [max_outliers] outliers, spread evenly over its sorted outliers
+    so the most extreme ones stay."""
+    max_outliers = box_max_outliers if max_outliers is None else max_outliers
+    df = df[[value, weight] + ([by] if isinstance(by, str) else list(by))]
+    stats = weighted_quantile(df, value, [0.25, 0.5, 0.75], weight=weight, by=by)
+    stats = stats.rename(columns={0.25: "q1", 0.5: "median", 0.75: "q3"})
+
+    codes, _ = group_codes(df, by)
+    ok = (codes >= 0) & df[value].notna().to_numpy()
+    g, x = codes[ok], df[value].to_numpy(dtype=float)[ok]
+    q1, q3 = stats.q1.to_numpy(), stats.q3.to_numpy()
+    inside = (x >= (q1 - 1.5 * (q3 - q1))[g]) & (x <= (q3 + 1.5 * (q3 - q1))[g])
+    lower, upper = np.full(len(stats), np.inf), np.full(len(stats), -np.inf)
+    np.minimum.at(lower, g[inside], x[inside])
+    np.maximum.at(upper, g[inside], x[inside])
+    stats["lowerfence"], stats["upperfence"] = lower, upper
+
+    order = np.lexsort((x[~inside], g[~inside]))
+    out_g, out_x = g[~inside][order], x[~inside][order]
+    bounds = np.searchsorted(out_g, np.arange(len(stats) + 1))
+    outliers = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        keep = np.unique(np.linspace(lo, hi - 1, min(hi - lo, max_outliers)).round().astype(int))
+        outliers.append(out_x[keep])
+    stats["outliers"] = outliers
+    return stats
+
+def make_diff_dist(gss_clean):
+    """Box plots of income and job prestige by sex."""
+    df = expand(gss_clean[["sex", "income", "job_prestige", "weight"]])
+    variables = ["income", "job_prestige"]
+    stats = pd.concat([box_summary(df, v, "sex").assign(variable=v) for v in variables],
+                    ignore_index=True)
+    palette = px.colors.qualitative.Plotly
+    return box_facets_figure(stats, "variable", height=None,
+                    color_map={sex: palette[i % len(palette)]
+                            for i, sex in enumerate(df.sex.cat.categories)},
+                    titles={v: v.replace("_", " ").title() for v in variables})
+
+def prestige_groups(gss_clean):
+    """Income, sex, job prestige and weight rows with job_prest_grp, the
+    prestige level 1-6 (equal width bins)."""
+    gss6 = expand(gss_clean[["income", "sex", "job_prestige", "weight"]])
+    gss6['job_prest_grp'] = pd.cut(gss6.job_prestige, 6,
+                              labels = list(range(1,7)))
+    return gss6.dropna()
+
+def make_income_dist(gss_clean):
+    """Income box plots by sex, faceted over 6 job prestige levels."""
+    return income_groups_figure(prestige_groups(gss_clean))
+
+def income_groups_figure(gss6):
+    """Income box plots by sex from prestige_groups() rows."""
+    return box_facets_figure(box_summary(gss6, "income", ["job_prest_grp", "sex"]),
+                            "job_prest_grp")
+
+def box_facets_figure(stats, facet, wrap=2, height=600,
+                    color_map={'male':'blue', 'female':'red'}, titles=None):
+    """Box plots by sex from precomputed statistics, one facet per value
+    of [facet], laid out like px.box(facet_col=..., facet_col_wrap=wrap).
+    [stats] has sex, [facet], q1, median, q3, lowerfence and upperfence
+    columns, and optionally outliers, the points to draw beyond the
+    whiskers. [titles] maps facet values to subplot titles."""
+    from plotly.subplots import make_subplots
+
+    values = list(pd.unique(stats[facet]))
+    rows = -(-len(values) // wrap)
+    title = facet.replace("_", " ").title()
+    titles = titles or {}
+    fig = make_subplots(rows=rows, cols=wrap,
+                    subplot_titles=[titles.get(v, "{}={}".format(title, v)) for v in values],
+                    shared_xaxes=True, vertical_spacing=0.08)
+    for i, v in enumerate(values):
+        for _, rw in stats[stats[facet] == v].iterrows():
+            color = color_map.get(rw["sex"])
+            fig.add_trace(go.Box(x=[rw["sex"]], name=rw["sex"],
+                    q1=[rw["q1"]], median=[rw["median"]], q3=[rw["q3"]],
+                    lowerfence=[rw["lowerfence"]], upperfence=[rw["upperfence"]],
+                    marker=dict(color=color),
+                    showlegend=False),
+                row=i // wrap + 1, col=i % wrap + 1)
+            outliers = rw.get("outliers")
+            if outliers is not None and len(outliers):
+                fig.add_trace(go.Scatter(x=[rw["sex"]] * len(outliers), y=outliers,
+                        mode="markers", marker=dict(color=color, size=4),
+                        name=rw["sex"], showlegend=False,
+                        hovertemplate="%{y}<extra></extra>"),
+                    row=i // wrap + 1, col=i % wrap + 1)
+    fig.update_layout(height=height, showlegend=False)
+    fig.update(layout=dict(title=dict(x=0.5)))
+    return fig
+
+def income_dist_figure(stats):
+    """Prestige levels figure from cube box statistics by (prestige, sex)."""
+    stats = stats.rename(columns={"prestige": "job_prest_grp"})
+    return box_facets_figure(stats.dropna(subset=["median"]), "job_prest_grp")
+
+def make_violin_full(gss_clean):
+    """Income violin plots by sex with every respondent as a point."""
+    gss_clean = expand(gss_clean)
+    return px.violin(gss_clean, x="income",
+                color="sex", box=True,
+                points="all",
+                hover_data=gss_clean.columns)
+
+def kde_curve(values, grid_size=256):
+    """Gaussian KDE of [values] on an evenly spaced grid.
+    Values are binned onto the grid and convolved with the kernel,
+    so cost grows with the grid rather than with len(values).
+    Bandwidth and span follow plotly.js violins."""
+    n = len(values)
+    q1, q3 = np.percentile(values, [25, 75])
+    spread = min(values.std(ddof=1), (q3 - q1) / 1.349) or values.std(ddof=1) or 1.0
+    bw = 1.059 * spread * n ** -0.2
+
+    lo, hi = values.min() - 2 * bw, values.max() + 2 * bw
+    counts, edges = np.histogram(values, bins=grid_size, range=(lo, hi))
+    grid = (edges[:-1] + edges[1:]) / 2
+    dx = edges[1] - edges[0]
+
+    #kernel out to 4 bandwidths on either side
+    half = int(np.ceil(4 * bw / dx))
+    offsets = np.arange(-half, half + 1) * dx
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2)
+    density = np.convolve(counts, kernel)[half:half + grid_size]
+    density = density / (n * bw * np.sqrt(2 * np.pi))
+    return grid, density
+
+def box_stats(values, weights):
+    """Weighted q1/median/q3 and 1.5*IQR fences (clipped to the data)
+    for [values]."""
+    qs = weighted_quantile(pd.DataFrame({"v": values, "w": weights}),
+                        "v", [0.25, 0.5, 0.75], weight="w")
+    q1, med, q3 = qs[0.25][0], qs[0.5][0], qs[0.75][0]
+    iqr = q3 - q1
+    lower = values[values >= q1 - 1.5 * iqr].min()
+    upper = values[values <= q3 + 1.5 * iqr].max()
+    return {"q1": q1, "median": med, "q3": q3,
+            "lowerfence": lower, "upperfence": upper}
+
+def stratified_sample(df, by, n, seed=0):
+    """Up to [n] rows of [df], split across [by] in proportion to group size."""
+    if len(df) <= n:
+        return df
+    frac = n / len(df)
+    return df.groupby(by, group_keys=False, observed=True).apply(
+        lambda g: g.sample(int(round(len(g) * frac)), random_state=seed))
+
+def make_violin(gss_clean, sample_n=None, hover_cols=None):
+    """Income violin plots by sex from precomputed KDE curves and
+    quartiles, with a capped stratified sample of points.
+    make_violin_full() has every point."""
+    sample_n = violin_sample_n if sample_n is None else sample_n
+    hover_cols = violin_hover_cols if hover_cols is None else hover_cols
+
+    df = expand(gss_clean[["sex", "income", "weight"] + hover_cols]).dropna(subset=["sex", "income"])
+    sample = stratified_sample(df, "sex", sample_n)
+    colors = px.colors.qualitative.Plotly
+    rng = np.random.default_rng(0)
+    hovertemplate = "sex=%{meta}<br>income=%{x}" + "".join(
+        "<br>{}=%{{customdata[{}]}}".format(c, i) for i, c in enumerate(hover_cols)) + "<extra></extra>"
+
+    fig = go.Figure()
+    for i, sex in enumerate(df.sex.cat.categories):
+        vals = df.income[df.sex == sex].to_numpy(dtype=float)
+        weights = df.weight[df.sex == sex].to_numpy(dtype=float)
+        if len(vals) < 2:
+            continue
+        color = colors[i % len(colors)]
+
+        #violin outline, mirrored around y=i
+        grid, density = kde_curve(vals)
+        scale = 0.4 / density.max()
+        fig.add_trace(go.Scatter(
+            x=np.concatenate([grid, grid[::-1]]),
+            y=np.concatenate([i + density * scale, (i - density * scale)[::-1]]),
+            fill="toself", mode="lines", line=dict(color=color, width=1),
+            name=sex, legendgroup=sex, hoverinfo="skip"))
+
+        fig.add_trace(go.Box(
+            y=[i], orientation="h", width=0.1,
+            marker=dict(color=color), name=sex, legendgroup=sex,
+            showlegend=False, **{k: [v] for k, v in box_stats(vals, weights).items()}))
+
+        pts = sample[sample.sex == sex]
+        fig.add_trace(go.Scatter(
+            x=pts.income, y=i - 0.3 + rng.uniform(-0.08, 0.08, len(pts)),
+            mode="markers", marker=dict(color=color, size=4, opacity=0.6),
+            customdata=pts[hover_cols].to_numpy(), meta=sex,
+            hovertemplate=hovertemplate,
+            name=sex, legendgroup=sex, showlegend=False))
+
+    fig.update_yaxes(tickvals=list(range(len(df.sex.cat.categories))),
+                ticktext=list(df.sex.cat.categories), title_text="sex")
+    fig.update_xaxes(title_text="income")
+    fig.update_layout(legend_title_text="sex")
+    return fig
+
+#page name -> function building that page's plotly figure
+page_figures = {"violin": make_violin,
+                "violin_full": make_violin_full,
+                "table": make_table,
+                "roles": make_roles,
+                "prestige": make_prestige,
+                "diff_dist": make_diff_dist,
+                "income_dist": make_income_dist,
+                "beliefs": make_beliefs}
+
+def explain_figure(explanation):
+    """Bar chart of one respondent's largest SHAP contributions, from
+    shap_store.ShapStore.explain()."""
+    rows = explanation["rows"][::-1]
+    fig = go.Figure(go.Bar(
+        x=[c for _, _, c in rows], orientation="h",
+        y=["{} = {:g}".format(f, v) for f, v, _ in rows],
+        marker=dict(color=["red" if c < 0 else "black" for _, _, c in rows]),
+        hovertemplate="%{y}<br>%{x:$,.0f}<extra></extra>"))
+    fig.update_xaxes(title_text="Change in predicted income ($)")
+    fig.update_layout(height=150 + 30 * len(rows), margin=dict(l=10))
+    return fig
+
+def importance_chart(source, intervals=None, fmt="png"):
+    """Importance chart for the csv at [source], with error bars from the
+    saved bootstrap intervals unless [intervals] are given."""
+    #xgboost_analysis pulls in matplotlib, only worth it for the image
+    from xgboost_analysis import importance_image
+    if intervals is None:
+        import bootstrap
+        intervals = bootstrap.importance_intervals()
+    return importance_image(source, fmt=fmt, intervals=intervals)
+
+#page name -> function building that page's image from a csv source
+page_images = {"AI": importance_chart}
+
+#formats images are served in; webp needs a matplotlib/Pillow that can write it
+image_formats = ("png", "svg", "webp")
+
+def build_all(gss_clean, xgb_source=None, formats=image_formats):
+    """Build every page's figure and image.
+    Returns ({page: plotly figure}, {page: {format: bytes}}).
+    Formats this matplotlib cannot write are left out."""
+    figs = {}
+    for name, func in page_figures.items():
+        with stage("figure", page=name):
+            figs[name] = func(gss_clean)
+    images = {}
+    for name, func in page_images.items():
+        images[name] = {}
+        for fmt in formats:
+            try:
+                with stage("image", page=name, format=fmt):
+                    images[name][fmt] = func(xgb_source or xgb_csv(), fmt=fmt)
+            except ValueError:
+                pass
+    return figs, images
@@ -0,0 +1,476 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype
+from profiling import stage
+
+gss_source = os.environ.get("GSS_SOURCE",
+    "https://raw.githubusercontent.com/kipmccharen/dash-heroku-template/master/gss2018.csv")
+
+#importances behind the AI page: $XGB_CSV, else what train_xgboost.py
+#wrote next to this file, else the published copy on GitHub
+xgb_source_env = os.environ.get("XGB_CSV")
+xgb_local_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gss_xgboost_df.csv")
+xgb_remote_csv = "https://raw.githubusercontent.com/kipmccharen/dash-heroku-template/master/gss_xgboost_df.csv"
+
+def xgb_csv():
+    """Where the importance csv is read from right now, see above."""
+    if xgb_source_env:
+        return xgb_source_env
+    return xgb_local_csv if os.path.exists(xgb_local_csv) else xgb_remote_csv
+
+#optional cumulative GSS file (1972-present) with a 'year' column;
+#when set the app serves every year in it, otherwise only gss_year
+gss_cumulative_source = os.environ.get("GSS_CUMULATIVE_SOURCE")
+gss_year = 2018
+
+#how many survey years each worker keeps in memory at once
+max_resident_years = int(os.environ.get("GSS_MAX_YEARS", 4))
+
+#with GSS_SHARED=1 frames are served from read-only memory maps, one
+#copy in the page cache for every worker (gunicorn.conf.py turns it on)
+shared_frames = os.environ.get("GSS_SHARED", "") not in ("", "0")
+
+#cleaned frames are written here, one parquet file per source/config hash
+cache_dir = os.environ.get("GSS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+#bump this whenever clean_gss() changes in a way the config below can't see
+CLEAN_VERSION = 2
+
+na_values = ['IAP','IAP,DK,NA,uncodeable', 'NOT SURE',
+            'DK', 'IAP, DK, NA, uncodeable', '.a', "CAN'T CHOOSE"]
+
+mycols = ['id', 'wtss', 'sex', 'educ', 'region', 'age', 'coninc',
+          'prestg10', 'mapres10', 'papres10', 'sei10', 'satjob',
+          'fechld', 'fefam', 'fepol', 'fepresch', 'meovrwrk']
+
+rename_cols = {'wtss':'weight',
+                'educ':'education',
+                'coninc':'income',
+                'prestg10':'job_prestige',
+                'mapres10':'mother_job_prestige',
+                'papres10':'father_job_prestige',
+                'sei10':'socioeconomic_index',
+                'fechld':'relationship',
+                'fefam':'male_breadwinner',
+                'fehire':'hire_women',
+                'fejobaff':'preference_hire_women',
+                'fepol':'men_bettersuited',
+                'fepresch':'child_suffer',
+                'meovrwrk':'men_overwork'}
+
+cat_order = ['strongly agree', 'agree',
+    'neither agree nor disagree',
+    'disagree', 'strongly disagree']
+cat_type = CategoricalDtype(categories=cat_order,
+                ordered=True)
+colorder = ['relationship', 'male_breadwinner',
+    'men_bettersuited', 'child_suffer', 'men_overwork']
+
+cat_type_sex = CategoricalDtype(categories=["female", "male"],
+                ordered=True)
+
+#satjob answers from most to least satisfied, as the GSS codes them
+satjob_order = ['very satisfied', 'mod. satisfied',
+    'a little dissat', 'very dissatisfied']
+
+#what respondents were asked for each Likert column in cube.likert
+belief_questions = {
+    "relationship": "A working mother can establish just as warm and secure a relationship with her children as a mother who does not work.",
+    "male_breadwinner": "It is much better for everyone involved if the man is the achiever outside the home and the woman takes care of the home and family.",
+    "men_bettersuited": "Most men are better suited emotionally for politics than are most women.",
+    "child_suffer": "A preschool child is likely to suffer if his or her mother works.",
+    "men_overwork": "Family life often suffers because men concentrate too much on their work.",
+    "satjob": "On the whole, how satisfied are you with the work you do?"}
+
+#the question the beliefs page opens on
+belief_default = "male_breadwinner"
+
+#compact dtype per cleaned column, see compact(); a tuple is tried smallest
+#first, columns not listed keep theirs
+compact_schema = {'id': ('int16', 'int32'),
+                'region': 'category',
+                'satjob': 'category',
+                'education': 'float32',
+                'age': 'float32',
+                'income': 'float32',
+                'job_prestige': 'float32',
+                'mother_job_prestige': 'float32',
+                'father_job_prestige': 'float32',
+                'socioeconomic_index': 'float32',
+                'weight': 'float32'}
+
+def read_gss(source=gss_source):
+    """Read the raw GSS csv from [source] (URL or local path)."""
+    return pd.read_csv(source,
+                encoding='cp1252',
+                na_values=na_values)
+
+def restore_dtypes(gss_clean):
+    """Cast the categorical columns. Also used after reading several
+    parquet files as one, which does not keep the dtypes."""
+    for c in colorder:
+        if c in gss_clean:
+            gss_clean[c] = gss_clean[c].astype(cat_type)
+    if 'sex' in gss_clean:
+        gss_clean['sex'] = gss_clean['sex'].astype(cat_type_sex)
+    return gss_clean
+
+def clean_gss(gss):
+    """Cut the raw [gss] frame down to mycols, rename
+    and cast the categoricals."""
+    gss_clean = gss[mycols].copy()
+    gss_clean = gss_clean.rename(rename_cols, axis=1)
+    gss_clean = restore_dtypes(gss_clean)
+
+    gss_clean.age = gss_clean.age.replace({'89 or older':'89'})
+    gss_clean.age = gss_clean.age.astype('float')
+    return gss_clean
+
+def _decimals(x, most=6):
+    #fewest decimals that reproduce every value of float array [x]
+    for d in range(most + 1):
+        if np.array_equal(np.round(x, d), x, equal_nan=True):
+            return d
+    return None
+
+def lossless(col, dtype):
+    """True if casting Series [col] to [dtype] keeps every value: ints
+    must fit and have no gaps, floats must give back the same decimals."""
+    if dtype == 'category':
+        return True
+    x = col.to_numpy(dtype=float)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(dtype)
+        return (not np.isnan(x).any() and np.array_equal(np.round(x), x)
+                and (len(x) == 0 or (x.min() >= info.min and x.max() <= info.max)))
+    d = _decimals(x)
+    return d is not None and np.array_equal(
+        np.round(x.astype(dtype).astype(float), d), x, equal_nan=True)
+
+def compact(gss_clean, schema=compact_schema):
+    """Cast the columns of [gss_clean] to their [schema] dtype where that
+    loses nothing, in place. Returns the frame and a report of bytes
+    per column before and after."""
+    rows = []
+    for c in gss_clean.columns:
+        before = gss_clean[c].memory_usage(index=False, deep=True)
+        old = str(gss_clean[c].dtype)
+        candidates = schema.get(c, ())
+        for dtype in (candidates,) if isinstance(candidates, str) else candidates:
+            if old == dtype:
+                break
+            if lossless(gss_clean[c], dtype):
+                gss_clean[c] = gss_clean[c].astype(dtype)
+                break
+        after = gss_clean[c].memory_usage(index=False, deep=True)
+        rows.append((c, old, str(gss_clean[c].dtype), before, after, before - after))
+    report = pd.DataFrame(rows, columns=["column", "dtype_before", "dtype_after",
+                                        "bytes_before", "bytes_after", "saved"])
+    return gss_clean, report
+
+def expand(df):
+    """float64 copy of [df] for code that prints or serializes values:
+    float32 columns come back as the decimals they were read from
+    (65.3, not 65.30000305)."""
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype == np.float32:
+            #numpy prints a float32 as the shortest decimal that maps back to it
+            df[c] = df[c].to_numpy().astype(str).astype(float)
+    return df
+
+def clean_config():
+    """Everything clean_gss() depends on, as a json-able dict."""
+    return {"version": CLEAN_VERSION,
+            "na_values": na_values,
+            "mycols": mycols,
+            "rename_cols": rename_cols,
+            "cat_order": cat_order,
+            "colorder": colorder,
+            "sex_order": list(cat_type_sex.categories),
+            "compact_schema": compact_schema}
+
+def source_fingerprint(source):
+    """Identify [source]; local files also change key
+    when they are modified."""
+    if os.path.exists(source):
+        st = os.stat(source)
+        return "{}|{}|{}".format(os.path.abspath(source), st.st_size, st.st_mtime_ns)
+    return source
+
+def cache_key(source=gss_source):
+    """Hash of the source and the cleaning config."""
+    raw = json.dumps([source_fingerprint(source), clean_config()],
+                sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def cache_path(source=gss_source):
+    return os.path.join(cache_dir, "gss_clean-{}.parquet".format(cache_key(source)))
+
+def load_gss_clean(source=gss_source, use_cache=True):
+    """Return the cleaned GSS frame, reading it from the local
+    parquet cache when possible and filling the cache otherwise."""
+    path = cache_path(source)
+    if use_cache and os.path.exists(path):
+        with stage("load", cached=True):
+            return pd.read_parquet(path)
+
+    with stage("load", cached=False):
+        gss = read_gss(source)
+    with stage("clean"):
+        gss_clean = clean_gss(gss)
+    #the raw frame has every GSS column, nothing may keep it alive
+    del gss
+    with stage("compact"):
+        gss_clean, _ = compact(gss_clean)
+
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            #write to a temp name first so a half-written file is never read
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with stage("serialize", artifact="gss_clean.parquet"):
+                gss_clean.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+        except (OSError, ImportError):
+            #read-only slug or no parquet engine, serve uncached
+            pass
+    return gss_clean
+
+def partition_path(source):
+    return os.path.join(cache_dir, "gss_years-{}".format(cache_key(source)))
+
+def partition_schema():
+    """Arrow schema every partition file is written with. A csv chunk can
+    hold a sliver of a year whose text columns are all missing, or whose
+    numbers happen to have no gaps; left to pandas that part would be
+    written as null or int64 and the year's parts would no longer read
+    back as one table. Categoricals go in as strings, see restore_dtypes()."""
+    import pyarrow as pa
+    text = {"sex", "region", "satjob"} | set(colorder)
+    def field(c):
+        if c == "id":
+            return pa.field(c, pa.int64())
+        return pa.field(c, pa.string() if c in text else pa.float64())
+    return pa.schema([field(rename_cols.get(c, c)) for c in mycols])
+
+def partition_by_year(source, chunksize=50000):
+    """Clean the cumulative [source] csv into one parquet directory per
+    survey year. Only mycols are parsed and the file is read in chunks,
+    so memory stays flat however many years it holds."""
+    path = partition_path(source)
+    if os.path.exists(os.path.join(path, "_SUCCESS")):
+        return path
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = partition_schema()
+    text = [f.name for f in schema if f.type == pa.string()]
+    reader = pd.read_csv(source, encoding='cp1252', na_values=na_values,
+                usecols=mycols + ['year'], chunksize=chunksize)
+    with stage("partition", source=os.path.basename(source)):
+        for i, chunk in enumerate(reader):
+            for year, part in chunk.groupby('year'):
+                ydir = os.path.join(tmp, "year={}".format(int(year)))
+                os.makedirs(ydir, exist_ok=True)
+                part = clean_gss(part).astype({c: object for c in text})
+                pq.write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False),
+                    os.path.join(ydir, "part-{:05d}.parquet".format(i)))
+    open(os.path.join(tmp, "_SUCCESS"), "w").close()
+
+    #another worker may have finished first, either copy is fine
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return path
+
+def mmap_path(source, year):
+    return os.path.join(cache_dir, "gss_mmap-{}-{}".format(cache_key(source), year))
+
+def to_mmap(gss_clean, path):
+    """Write [gss_clean] to directory [path], one .npy per column
+    (categorical codes for categoricals) and meta.json with the column
+    order, dtypes and categories."""
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    meta = []
+    for i, c in enumerate(gss_clean.columns):
+        col = gss_clean[c]
+        if col.dtype == object:
+            #python objects cannot be mapped, strings go in as codes
+            col = col.astype("category")
+        if hasattr(col, "cat"):
+            values = col.cat.codes.to_numpy()
+            meta.append({"name": c, "categories": list(col.cat.categories),
+                        "ordered": bool(col.cat.ordered)})
+        else:
+            values = col.to_numpy()
+            meta.append({"name": c})
+        np.save(os.path.join(tmp, "{}.npy".format(i)), values)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        #another worker wrote it first
+        shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        os.replace(tmp, path)
+    return path
+
+def open_mmap(path):
+    """Read-only frame on the memory-mapped columns written by to_mmap().
+    Nothing is copied: every process that opens it shares the same
+    pages, and writes into it raise ValueError."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    cols = {}
+    for i, m in enumerate(meta):
+        values = np.load(os.path.join(path, "{}.npy".format(i)), mmap_mode="r")
+        if "categories" in m:
+            values = pd.Categorical.from_codes(values, m["categories"], ordered=m["ordered"])
+        cols[m["name"]] = values
+    #copy=False keeps one block per column, each a view of its map
+    return pd.DataFrame(cols, copy=False)
+
+class GSSDataset:
+    """Cleaned GSS data by survey year, loaded on demand.
+
+    Years are read from per-year parquet partitions the first time they
+    are asked for and at most [max_years] of them stay in memory, least
+    recently used years are dropped first. Without a cumulative source
+    the dataset is just gss_year read through load_gss_clean(). With
+    [shared] each year is written once with to_mmap() and every process
+    maps the same read-only files.
+    """
+    def __init__(self, cumulative_source=gss_cumulative_source,
+                source=gss_source, max_years=max_resident_years, shared=shared_frames):
+        self.cumulative_source = cumulative_source
+        self.source = source
+        self.max_years = max(1, max_years)
+        #serve frames from read-only maps shared by every worker
+        self.shared = shared
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._years = None
+        self._fingerprint = None
+
+    def years(self):
+        """Sorted survey years available."""
+        if self._years is None:
+            if self.cumulative_source:
+                path = partition_by_year(self.cumulative_source)
+                self._years = sorted(int(d.split("=")[1]) for d in os.listdir(path)
+                                    if d.startswith("year="))
+            else:
+                self._years = [gss_year]
+        return self._years
+
+    def refresh(self):
+        """Forget loaded years if the source file changed since they were
+        read. Returns the source fingerprint."""
+        fingerprint = source_fingerprint(self.cumulative_source or self.source)
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self._frames.clear()
+                self._years = None
+                self._fingerprint = fingerprint
+        return fingerprint
+
+    @property
+    def default_year(self):
+        return self.years()[-1]
+
+    def _read(self, year):
+        if not self.shared:
+            return self._clean(year)
+        path = mmap_path(self.cumulative_source or self.source, year)
+        if not os.path.exists(path):
+            try:
+                to_mmap(self._clean(year), path)
+            except OSError:
+                #read-only slug, keep the frame private
+                return self._clean(year)
+        with stage("load", year=year, mmap=True):
+            return open_mmap(path)
+
+    def _clean(self, year):
+        if not self.cumulative_source:
+            return load_gss_clean(self.source)
+        ydir = os.path.join(partition_by_year(self.cumulative_source),
+                            "year={}".format(year))
+        columns = [rename_cols.get(c, c) for c in mycols]
+        with stage("load", year=year, cached=True):
+            gss_clean = restore_dtypes(pd.read_parquet(ydir, columns=columns))
+        with stage("compact", year=year):
+            return compact(gss_clean)[0]
+
+    def load(self, year=None):
+        """Cleaned frame for [year] (default: latest year)."""
+        year = self.default_year if year is None else int(year)
+        if year not in self.years():
+            raise KeyError("no GSS data for year {}".format(year))
+        with self._lock:
+            if year in self._frames:
+                self._frames.move_to_end(year)
+                return self._frames[year]
+        df = self._read(year)
+        with self._lock:
+            self._frames[year] = df
+            self._frames.move_to_end(year)
+            while len(self._frames) > self.max_years:
+                self._frames.popitem(last=False)
+        return df
+
+    def iter_batches(self, year, batch_rows=10000, columns=None):
+        """Cleaned rows of [year] in frames of at most [batch_rows], only
+        [columns] if given, straight from the year's parquet partition
+        with a cumulative source, so memory stays flat and the resident
+        years are left alone. Without one the loaded frame is sliced."""
+        year = int(year)
+        if year not in self.years():
+            raise KeyError("no GSS data for year {}".format(year))
+        if not self.cumulative_source:
+            df = self.load(year)
+            if columns is not None:
+                df = df[list(columns)]
+            for start in range(0, len(df), batch_rows):
+                yield df.iloc[start:start + batch_rows]
+            return
+        import pyarrow.parquet as pq
+        ydir = os.path.join(partition_by_year(self.cumulative_source),
+                            "year={}".format(year))
+        if columns is None:
+            columns = [rename_cols.get(c, c) for c in mycols]
+        for name in sorted(os.listdir(ydir)):
+            for batch in pq.ParquetFile(os.path.join(ydir, name)).iter_batches(
+                    batch_rows, columns=list(columns)):
+                yield restore_dtypes(batch.to_pandas())
+
+    def resident_years(self):
+        """Years currently held in memory, least recently used first."""
+        return list(self._frames)
+
+if __name__ == '__main__':
+    import sys
+    if "--report" in sys.argv:
+        #what compact() saves on a freshly cleaned frame
+        gss_clean, report = compact(clean_gss(read_gss()))
+        print(report.to_string(index=False))
+        print("total {:,} -> {:,} bytes".format(report.bytes_before.sum(), report.bytes_after.sum()))
+        sys.exit()
+
+    #warm the cache, e.g. from a build or release step
+    if gss_cumulative_source:
+        print("{} years partitioned at {}".format(
+            len(GSSDataset().years()), partition_path(gss_cumulative_source)))
+    else:
+        df = load_gss_clean()
+        print("{} rows cached at {}".format(len(df), cache_path()))
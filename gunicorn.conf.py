@@ -0,0 +1,30 @@
+"""Gunicorn settings for the Procfile.
+
+The app is loaded once in the master (preload_app) with GSS_SHARED on,
+so the cleaned frames are read-only memory maps and the page responses
+are warmed into the response cache before any worker is forked. Worker
+memory then is mostly pages shared with the master. gc.freeze() keeps
+the collector from writing to the master's objects, which would copy
+their pages into every worker. GUNICORN_PRELOAD=0 loads the app in each
+worker instead.
+
+Workers are gthread workers, so one slow figure request holds a thread
+rather than a whole worker. Figure builds themselves are limited to
+FIGURE_THREADS per worker (see app.py).
+"""
+import os
+import gc
+
+os.environ.setdefault("GSS_SHARED", "1")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+def when_ready(server):
+    #runs in the master after the app is loaded, before the first fork
+    if preload_app:
+        import app
+        app.warm()
+        gc.freeze()
@@ -0,0 +1,117 @@
+"""Latency, response size and error metrics for the Dash callbacks.
+
+Every POST to /_dash-update-component is timed from the first
+before_request hook to the last after_request hook, so cached
+responses are measured too, and recorded per callback and per page.
+/metrics serves the counters in the Prometheus text format. Each
+gunicorn worker keeps and reports its own numbers.
+"""
+import time
+import bisect
+import threading
+from flask import Response, g, request
+
+#seconds
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+#bytes on the wire, after any compression
+size_buckets = (1000, 4000, 16000, 64000, 256000, 1000000, 4000000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in items) + "}"
+
+class CallbackMetrics:
+    def __init__(self, pages):
+        #the label values a page can take, anything else is "other"
+        self.pages = list(pages)
+        self.latency = {}
+        self.size = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.latency, self.size, self.errors = {}, {}, {}
+
+    def page_label(self, page):
+        return page if page in self.pages else "other"
+
+    def record(self, callback, page, seconds, nbytes, error=False):
+        key = (("callback", callback), ("page", self.page_label(page)))
+        with self._lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram(latency_buckets)
+                self.size[key] = Histogram(size_buckets)
+                self.errors[key] = 0
+            self.latency[key].observe(seconds)
+            self.size[key].observe(nbytes)
+            self.errors[key] += bool(error)
+
+    def _histogram(self, name, doc, series):
+        lines = ["# HELP {} {}".format(name, doc), "# TYPE {} histogram".format(name)]
+        for key, h in sorted(series.items()):
+            cumulative = 0
+            for le, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(name, _labels(key, le=le), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(key), h.sum))
+            lines.append("{}_count{} {}".format(name, _labels(key), h.count))
+        return lines
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = self._histogram("dash_callback_duration_seconds",
+                        "Time to answer a callback request.", self.latency)
+            lines += self._histogram("dash_callback_response_bytes",
+                        "Size of the callback response body.", self.size)
+            lines += ["# HELP dash_callback_errors_total Callback requests answered with a 5xx.",
+                    "# TYPE dash_callback_errors_total counter"]
+            lines += ["dash_callback_errors_total{} {}".format(_labels(key), n)
+                    for key, n in sorted(self.errors.items())]
+        return "\n".join(lines) + "\n"
+
+def install(server, metrics, page_of, path="/_dash-update-component"):
+    """Measure callback requests on the Flask [server] into [metrics] and
+    serve them at /metrics. [page_of] maps a callback request body to the
+    page it belongs to. Install before any hook that may answer early,
+    such as response_cache.install, so those answers are measured too."""
+
+    @server.before_request
+    def _start_timer():
+        if request.method == "POST" and request.path.endswith(path):
+            g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def _observe(resp):
+        start = getattr(g, "metrics_start", None)
+        if start is None:
+            return resp
+        payload = request.get_json(silent=True) or {}
+        nbytes = 0 if resp.direct_passthrough else len(resp.get_data())
+        metrics.record(payload.get("output", ""), page_of(payload),
+                time.perf_counter() - start, nbytes,
+                error=resp.status_code >= 500)
+        return resp
+
+    @server.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(),
+                mimetype="text/plain; version=0.0.4; charset=utf-8")
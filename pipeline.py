@@ -0,0 +1,221 @@
+"""Lazy, dependency-tracked graph of the dashboard's data and figures.
+
+Each dataset and figure is a named node with declared inputs. A node is
+computed the first time it is asked for, memoized, and computed again
+only when the version of something upstream changes: source nodes
+report a version (for files, their path, size and mtime), every other
+node's version is derived from its inputs'. Nothing runs at import, so
+a worker only pays for the pages that get traffic.
+
+    graph = gss_pipeline(GSSDataset())
+    graph.get("table", year=2018)
+"""
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from profiling import stage
+
+class Node:
+    def __init__(self, name, func, inputs=(), params=(), version=None, memo=True,
+                maxsize=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        #keyword arguments (e.g. year) the function takes besides its inputs
+        self.params = tuple(params)
+        #callable(**params) -> str for source nodes, None for derived ones
+        self.version = version
+        self.memo = memo
+        #values kept in a memo of their own this big, None for the shared one
+        self.maxsize = maxsize
+
+class Pipeline:
+    def __init__(self, maxsize=64):
+        self.nodes = {}
+        #params a node depends on, directly or through its inputs
+        self._scope = {}
+        self.maxsize = maxsize
+        self._memo = OrderedDict()
+        self._own_memos = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def add(self, name, func, inputs=(), params=(), version=None, memo=True,
+            maxsize=None):
+        """Register node [name] computed as func(*inputs, **params).
+        Inputs must already be registered. With [maxsize] its values get
+        an LRU of their own, so a node with many params can't push the
+        others out of the shared one."""
+        for i in inputs:
+            if i not in self.nodes:
+                raise KeyError("unknown input {!r} of node {!r}".format(i, name))
+        self.nodes[name] = Node(name, func, inputs, params, version, memo, maxsize)
+        if maxsize is not None:
+            self._own_memos[name] = OrderedDict()
+        scope = set(params)
+        for i in inputs:
+            scope |= self._scope[i]
+        self._scope[name] = frozenset(scope)
+        return self.nodes[name]
+
+    def node(self, name, inputs=(), params=(), version=None, memo=True):
+        """Decorator form of add()."""
+        def wrap(func):
+            self.add(name, func, inputs, params, version, memo)
+            return func
+        return wrap
+
+    def _memo_of(self, name):
+        return self._own_memos.get(name, self._memo)
+
+    def _key(self, name, params):
+        return (name,) + tuple(sorted((p, params[p]) for p in self._scope[name]))
+
+    def version(self, name, **params):
+        """Version string of node [name]; changes whenever any source
+        upstream of it does."""
+        node = self.nodes[name]
+        if node.version is not None:
+            return str(node.version(**{p: params[p] for p in node.params}))
+        parts = [name, [self.version(i, **params) for i in node.inputs]]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+    def get(self, name, **params):
+        """Value of node [name], computed (with whatever it needs) only
+        if there is no memoized value for the current version."""
+        node = self.nodes[name]
+        missing = self._scope[name] - set(params)
+        if missing:
+            raise TypeError("node {!r} needs {}".format(name, ", ".join(sorted(missing))))
+        if not node.memo:
+            return self._compute(node, params)
+
+        key = self._key(name, params)
+        version = self.version(name, **params)
+        memo = self._memo_of(name)
+        with self._lock:
+            hit = memo.get(key)
+            if hit is not None and hit[0] == version:
+                memo.move_to_end(key)
+                return hit[1]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        #one thread computes a key, others asking for it wait for the result
+        with key_lock:
+            with self._lock:
+                hit = memo.get(key)
+                if hit is not None and hit[0] == version:
+                    return hit[1]
+            value = self._compute(node, params)
+            maxsize = self.maxsize if node.maxsize is None else node.maxsize
+            with self._lock:
+                memo[key] = (version, value)
+                memo.move_to_end(key)
+                while len(memo) > maxsize:
+                    memo.popitem(last=False)
+        return value
+
+    def peek(self, name, **params):
+        """Memoized value of node [name] for the current version,
+        KeyError when get() would have to compute it."""
+        node = self.nodes[name]
+        if not node.memo:
+            raise KeyError(name)
+        key = self._key(name, params)
+        version = self.version(name, **params)
+        memo = self._memo_of(name)
+        with self._lock:
+            hit = memo.get(key)
+            if hit is None or hit[0] != version:
+                raise KeyError(name)
+            memo.move_to_end(key)
+            return hit[1]
+
+    def _compute(self, node, params):
+        args = [self.get(i, **params) for i in node.inputs]
+        with stage("node", node=node.name, **{p: params[p] for p in node.params}):
+            return node.func(*args, **{p: params[p] for p in node.params})
+
+    def downstream(self, name):
+        """Names of the nodes that depend on [name], in registration order."""
+        out = []
+        for n in self.nodes.values():
+            if any(i == name or i in out for i in n.inputs):
+                out.append(n.name)
+        return out
+
+    def invalidate(self, name=None):
+        """Drop memoized values of node [name] and everything downstream
+        of it, or of every node."""
+        drop = set(self.nodes) if name is None else {name, *self.downstream(name)}
+        with self._lock:
+            for memo in [self._memo, *self._own_memos.values()]:
+                for key in [k for k in memo if k[0] in drop]:
+                    del memo[key]
+
+def _figures(attr):
+    #figures pulls in plotly.express, so it is only imported by a node that needs it
+    def call(*args, **kwargs):
+        import figures
+        return getattr(figures, attr)(*args, **kwargs)
+    call.__name__ = attr
+    return call
+
+def _intervals_version():
+    import bootstrap
+    from gss_data import source_fingerprint
+    return source_fingerprint(bootstrap.intervals_json)
+
+def gss_pipeline(dataset, xgb_source=None, maxsize=64, likert_maxsize=64):
+    """The dashboard's graph over [dataset] (a GSSDataset). Page
+    figures are nodes named like figures.page_figures, the importance
+    chart is node "AI" with a fmt param. [maxsize] values are kept, and
+    besides them [likert_maxsize] of the per-(year, column) "likert" cubes."""
+    from gss_data import source_fingerprint
+    import cube
+
+    graph = Pipeline(maxsize)
+    #the dataset keeps its own bounded set of years, so frames are not
+    #memoized twice; checking the version drops them if the file changed
+    frame_version = lambda year: "{}|{}".format(dataset.refresh(), year)
+    graph.add("gss_clean", lambda year: dataset.load(year), params=("year",),
+            version=frame_version, memo=False)
+    graph.add("cube", cube.GSSCube, ["gss_clean"])
+    graph.add("beliefs", _figures("default_beliefs_figure"), ["cube"])
+    #crosstabs of one Likert column over every year: a cube of no measures
+    #per year, from a few columns read without loading the year
+    def likert_cube(year, column):
+        import pandas as pd
+        rows = pd.concat(dataset.iter_batches(year, columns=cube.base_columns + [column]),
+                        ignore_index=True)
+        return cube.GSSCube(rows, measures=(), likert={column: cube.likert[column]})
+    graph.add("likert", likert_cube, params=("year", "column"),
+            version=lambda year, column: frame_version(year), maxsize=likert_maxsize)
+
+    graph.add("gss_grp", _figures("table_means"), ["gss_clean"])
+    graph.add("table", _figures("table_figure"), ["gss_grp"])
+    graph.add("bread", _figures("roles_counts"), ["gss_clean"])
+    graph.add("roles", _figures("roles_figure"), ["bread"])
+    graph.add("gss6", _figures("prestige_groups"), ["gss_clean"])
+    graph.add("income_dist", _figures("income_groups_figure"), ["gss6"])
+    graph.add("prestige_points", _figures("prestige_points"), ["gss_clean"])
+    graph.add("prestige", _figures("prestige_figure"), ["prestige_points"])
+    for name, attr in [("violin", "make_violin"), ("violin_full", "make_violin_full"),
+                    ("diff_dist", "make_diff_dist")]:
+        graph.add(name, _figures(attr), ["gss_clean"])
+
+    def xgb_path():
+        if xgb_source is not None:
+            return xgb_source
+        from gss_data import xgb_csv
+        return xgb_csv()
+    graph.add("xgb_source", xgb_path,
+            version=lambda: source_fingerprint(xgb_path()))
+    def intervals():
+        import bootstrap
+        return bootstrap.importance_intervals()
+    graph.add("importance_intervals", intervals, version=_intervals_version)
+    graph.add("AI", _figures("importance_chart"), ["xgb_source", "importance_intervals"],
+            params=("fmt",))
+    return graph
@@ -0,0 +1,113 @@
+"""Startup instrumentation for the data and figure pipeline.
+
+With STARTUP_PROFILE=1 every stage wrapped in stage()/profiled() is
+timed and measured (peak Python allocation via tracemalloc, and the
+process RSS after it), logged as one json line on stderr, which
+gunicorn --log-file=- sends to the dyno log, and listed by
+/_debug/startup. Otherwise stage() is a shared no-op context manager
+and profiled() returns the function untouched, so it costs nothing.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import contextlib
+
+enabled = os.environ.get("STARTUP_PROFILE", "") not in ("", "0")
+
+#finished stages, in the order they finished
+stages = []
+
+#import this module first so startup is measured from here
+started = time.perf_counter()
+
+logger = logging.getLogger("gss.startup")
+
+if enabled:
+    import tracemalloc
+    tracemalloc.start()
+    if not logger.handlers:
+        _handler = logging.StreamHandler(sys.stderr)
+        _handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(_handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+_noop = contextlib.nullcontext()
+
+def rss_bytes():
+    """Resident set size of this process, 0 where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+class _Stage:
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        self.alloc_before = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        current, peak = tracemalloc.get_traced_memory()
+        record = {"event": "startup_stage", "stage": self.name,
+                "seconds": round(seconds, 4),
+                "alloc_bytes": current - self.alloc_before,
+                "alloc_peak_bytes": peak - self.alloc_before,
+                "rss_bytes": rss_bytes(), "pid": os.getpid(),
+                "failed": exc[0] is not None, **self.info}
+        stages.append(record)
+        logger.info(json.dumps(record))
+        return False
+
+def stage(name, **info):
+    """Context manager measuring the stage [name]; [info] is added to
+    its record."""
+    if not enabled:
+        return _noop
+    return _Stage(name, info)
+
+def profiled(name):
+    """Decorator measuring every call of a function as stage [name]."""
+    def wrap(func):
+        if not enabled:
+            return func
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with _Stage(name, {}):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+def ready(name="app ready"):
+    """Record the time and memory from import of this module until now,
+    call once the app module has finished loading."""
+    if not enabled:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    record = {"event": "startup_stage", "stage": name,
+            "seconds": round(time.perf_counter() - started, 4),
+            "alloc_bytes": current, "alloc_peak_bytes": peak,
+            "rss_bytes": rss_bytes(), "pid": os.getpid(), "failed": False}
+    stages.append(record)
+    logger.info(json.dumps(record))
+
+def report():
+    """All stages so far with per-stage totals, for /_debug/startup."""
+    totals = {}
+    for s in stages:
+        t = totals.setdefault(s["stage"], {"calls": 0, "seconds": 0.0})
+        t["calls"] += 1
+        t["seconds"] = round(t["seconds"] + s["seconds"], 4)
+    return {"enabled": enabled, "pid": os.getpid(), "rss_bytes": rss_bytes(),
+            "stages": stages, "totals": totals}
@@ -0,0 +1,216 @@
+"""Response cache for pure Dash callbacks.
+
+A pure callback's output depends only on its inputs (and, for one that
+reads callback_context.triggered, on which of them changed), so the
+serialized response can be kept and sent again for the same inputs. Responses are
+stored already compressed (gzip, and brotli when the brotli package is
+installed) and the variant the browser accepts is sent as is, so a hit
+costs neither the callback, the JSON serialization nor the compression.
+
+Entries live in a bounded in-process LRU. A shared backend with
+get/set (FileCache for workers on one dyno, MemoryCache as a stand-in
+for something like redis) is consulted on a local miss.
+"""
+import os
+import json
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import Response, g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#bodies smaller than this are not worth compressing
+min_compress_size = 500
+
+class MemoryCache:
+    """Shared-cache stand-in, a plain dict."""
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value):
+        self._data[key] = value
+
+class FileCache:
+    """Shared cache in a directory, one file per key and encoding, for
+    the workers of one machine. Reads touch an entry's files; once they
+    add up to more than [max_bytes] the least recently used entries (by
+    mtime) are deleted. Each worker checks after writing a sixteenth of
+    that, so the directory overshoots by at most that much per worker."""
+    def __init__(self, path, max_bytes=256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._written = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key, enc):
+        return os.path.join(self.path, "{}.{}".format(key, enc))
+
+    def get(self, key):
+        entry = {}
+        for enc in ("identity", "gzip", "br"):
+            try:
+                with open(self._file(key, enc), "rb") as f:
+                    entry[enc] = f.read()
+                os.utime(self._file(key, enc))
+            except OSError:
+                pass
+        return entry or None
+
+    def set(self, key, value):
+        for enc, body in value.items():
+            path = self._file(key, enc)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+                self._written += len(body)
+            except OSError:
+                pass
+        if self._written >= self.max_bytes // 16:
+            self._written = 0
+            self.prune()
+
+    def prune(self):
+        """Delete least recently used entries until the directory holds
+        at most max_bytes."""
+        entries = {}
+        with os.scandir(self.path) as it:
+            for f in it:
+                if f.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = f.stat()
+                except OSError:
+                    continue
+                key = f.name.split(".", 1)[0]
+                used, size, files = entries.get(key, (0, 0, []))
+                entries[key] = (max(used, st.st_mtime), size + st.st_size, files + [f.path])
+        total = sum(size for _, size, _ in entries.values())
+        for used, size, files in sorted(entries.values()):
+            if total <= self.max_bytes:
+                break
+            for path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+def compress(body):
+    """{encoding: bytes} variants of a response [body]."""
+    entry = {"identity": body}
+    if len(body) >= min_compress_size:
+        entry["gzip"] = gzip.compress(body, 6)
+        if brotli is not None:
+            entry["br"] = brotli.compress(body, quality=5)
+    return entry
+
+class ResponseCache:
+    def __init__(self, maxsize=256, shared=None, version=""):
+        self.maxsize = maxsize
+        self.shared = shared
+        #part of every key, so a new deploy never sees old responses; a
+        #callable is asked on every request
+        self.version = version
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def key(self, payload, triggered=False):
+        """Cache key of a callback request body: the output and the
+        values of its inputs and state, and with [triggered] the inputs
+        that changed (changedPropIds), nothing else."""
+        version = self.version() if callable(self.version) else self.version
+        parts = [version, payload.get("output"),
+                [(i.get("id"), i.get("property"), i.get("value"))
+                    for i in payload.get("inputs", [])],
+                [(s.get("id"), s.get("property"), s.get("value"))
+                    for s in payload.get("state", [])]]
+        if triggered:
+            parts.append(sorted(payload.get("changedPropIds") or []))
+        raw = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key]
+        entry = self.shared.get(key) if self.shared is not None else None
+        if entry is not None:
+            self._remember(key, entry)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, key, body):
+        entry = compress(body)
+        self._remember(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._lru[key] = entry
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+def pick_encoding(entry):
+    """Best variant of [entry] the request accepts."""
+    accepted = request.accept_encodings
+    for enc in ("br", "gzip"):
+        if enc in entry and accepted[enc]:
+            return enc
+    return "identity"
+
+def respond(entry):
+    enc = pick_encoding(entry)
+    resp = Response(entry[enc], mimetype="application/json")
+    if enc != "identity":
+        resp.headers["Content-Encoding"] = enc
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+def install(server, cache, pure_outputs, triggered_outputs=(),
+            path="/_dash-update-component"):
+    """Serve callbacks whose output is in [pure_outputs] from [cache]
+    on the Flask [server]. Those also in [triggered_outputs] read
+    callback_context.triggered, so which input fired is part of their key."""
+    pure_outputs = set(pure_outputs)
+    triggered_outputs = set(triggered_outputs)
+
+    @server.before_request
+    def _cached_callback():
+        if request.method != "POST" or not request.path.endswith(path):
+            return None
+        payload = request.get_json(silent=True) or {}
+        if payload.get("output") not in pure_outputs:
+            return None
+        g.response_cache_key = cache.key(payload,
+                payload.get("output") in triggered_outputs)
+        entry = cache.get(g.response_cache_key)
+        if entry is not None:
+            g.response_cache_key = None
+            return respond(entry)
+        return None
+
+    @server.after_request
+    def _store_callback(resp):
+        key = getattr(g, "response_cache_key", None)
+        #only plain 200 json bodies, a 204 is dash's PreventUpdate
+        if not key or resp.status_code != 200 or resp.direct_passthrough:
+            return resp
+        return respond(cache.put(key, resp.get_data()))
@@ -0,0 +1,167 @@
+"""Per-respondent SHAP contributions of the income model, computed
+offline and served from memory-mapped files.
+
+    python shap_store.py [--year YEAR] [--out DIR] [--force]
+
+The model is trained as in train_xgboost.py. Contributions come from
+xgboost's own TreeSHAP (predict(pred_contribs=True)), one batch of rows
+per task on a process pool. Each worker writes its rows straight into
+the output matrix, so no results are pickled back. The store holds
+float32 .npy files ordered by respondent id:
+
+    ids.npy         int64 (n,)
+    features.npy    float32 (n, f), the model's inputs
+    contribs.npy    float32 (n, f + 1), per feature, last column the bias
+    income.npy      float32 (n,), reported income
+    meta.json       feature names, build key
+
+ShapStore maps them read-only. A row lookup is a slice of the map, so
+every gunicorn worker reads the same page cache instead of keeping its
+own copy. Only respondents who reported an income are in the store.
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from gss_data import cache_dir
+from profiling import stage
+
+store_dir = os.environ.get("SHAP_STORE", os.path.join(cache_dir, "shap"))
+
+#rows per task
+batch_rows = 512
+
+_worker = {}
+
+def _open_worker(path):
+    import xgboost
+    booster = xgboost.Booster(model_file=os.path.join(path, "model.json"))
+    booster.set_param({"nthread": 1})
+    _worker["booster"] = booster
+    _worker["features"] = np.load(os.path.join(path, "features.npy"), mmap_mode="r")
+    _worker["contribs"] = np.load(os.path.join(path, "contribs.npy"), mmap_mode="r+")
+
+def _explain_rows(start, stop):
+    import xgboost
+    X = np.asarray(_worker["features"][start:stop])
+    booster, out = _worker["booster"], _worker["contribs"]
+    dm = xgboost.DMatrix(X, feature_names=booster.feature_names)
+    out[start:stop] = booster.predict(dm, pred_contribs=True)
+    out.flush()
+    return stop - start
+
+def build(gss_clean, out=store_dir, key="", workers=None, n_jobs=-1):
+    """Train the model on [gss_clean] and write the store to [out]."""
+    from train_xgboost import fit_model, feature_matrix
+
+    model, X, _ = fit_model(gss_clean, n_jobs)
+    _, y, _ = feature_matrix(gss_clean)
+    ids = gss_clean.loc[X.index, "id"].to_numpy(dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+
+    #built beside the old store and swapped in whole, like the year partitions
+    tmp = "{}.{}.tmp".format(out, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "ids.npy"), ids[order])
+    np.save(os.path.join(tmp, "income.npy"), y[order].astype(np.float32))
+    np.save(os.path.join(tmp, "features.npy"), X.to_numpy(dtype=np.float32)[order])
+    contribs = np.lib.format.open_memmap(os.path.join(tmp, "contribs.npy"), mode="w+",
+                    dtype=np.float32, shape=(len(ids), X.shape[1] + 1))
+    del contribs
+    model.get_booster().save_model(os.path.join(tmp, "model.json"))
+
+    starts = list(range(0, len(ids), batch_rows))
+    stops = [min(s + batch_rows, len(ids)) for s in starts]
+    with stage("shap", rows=len(ids)), \
+            ProcessPoolExecutor(workers, initializer=_open_worker, initargs=(tmp,)) as pool:
+        done = sum(pool.map(_explain_rows, starts, stops))
+
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"features": list(X.columns), "rows": done, "key": key}, f, indent=1)
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    return done
+
+def stored_key(path=store_dir):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f).get("key")
+    except (OSError, ValueError):
+        return None
+
+class ShapStore:
+    """Read-only view of a built store."""
+    def __init__(self, path=store_dir):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.feature_names = self.meta["features"]
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.ids = load("ids.npy")
+        self.features = load("features.npy")
+        self.contribs = load("contribs.npy")
+        self.income = load("income.npy")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, respondent):
+        """Row of respondent id [respondent], KeyError if not stored."""
+        i = int(np.searchsorted(self.ids, respondent))
+        if i >= len(self.ids) or self.ids[i] != respondent:
+            raise KeyError(respondent)
+        return i
+
+    def row(self, respondent):
+        """(feature values, contributions, bias, reported income) of one
+        respondent; the arrays are views into the maps."""
+        i = self.index(respondent)
+        return (self.features[i], self.contribs[i, :-1],
+                float(self.contribs[i, -1]), float(self.income[i]))
+
+    def explain(self, respondent, top=15):
+        """The [top] features that move [respondent]'s prediction most,
+        as rows of (feature, value, contribution), and the prediction
+        and bias."""
+        values, contribs, bias, income = self.row(respondent)
+        pick = np.argsort(-np.abs(contribs), kind="stable")[:top]
+        rows = [(self.feature_names[j], float(values[j]), float(contribs[j])) for j in pick]
+        return {"rows": rows, "bias": bias, "prediction": bias + float(contribs.sum()),
+                "income": income}
+
+_opened = {}
+
+def open_store(path=store_dir):
+    """ShapStore at [path], None when it has not been built. Reopened
+    when the store is rebuilt."""
+    try:
+        mtime = os.stat(os.path.join(path, "meta.json")).st_mtime_ns
+    except OSError:
+        return None
+    if _opened.get(path, (None,))[0] != mtime:
+        _opened[path] = (mtime, ShapStore(path))
+    return _opened[path][1]
+
+if __name__ == '__main__':
+    from gss_data import GSSDataset
+    from train_xgboost import stamp_key
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--year", type=int, help="survey year (default: latest)")
+    parser.add_argument("--out", default=store_dir, help="store directory (default: %(default)s)")
+    parser.add_argument("--workers", type=int, help="processes (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="build even if up to date")
+    args = parser.parse_args()
+
+    dataset = GSSDataset()
+    year = args.year or dataset.default_year
+    key = stamp_key(dataset, year)
+    if not args.force and stored_key(args.out) == key:
+        print("{} is up to date".format(args.out))
+    else:
+        start = time.time()
+        rows = build(dataset.load(year), args.out, key, args.workers)
+        print("wrote {} respondents to {} in {:.1f}s".format(rows, args.out, time.time() - start))
@@ -0,0 +1,214 @@
+"""Static snapshot of every page, for a CDN or for serving pages without
+building anything.
+
+    python snapshot.py [--out snapshot] [--live-url https://gss-dash.herokuapp.com]
+
+Each page in app.pages is rendered as a browser would see it on first
+load: the page content, with every callback that fills it (graphs, the
+table's income text, ...) already answered with first-load inputs.
+Components marked className="live-only" (the year selector, filters,
+buttons) only do something against the live app and are left out; each
+page links to its interactive version instead.
+
+The output is Dash's own front end pointed at static files:
+
+    index.html, <page>/index.html       Dash's index page, one per route
+    _snap/<hash>/_dash-layout           the route's layout, figures included;
+    _snap/<hash>/_dash-dependencies     no callbacks; <hash> is of the layout
+    _dash-component-suites/...          the renderer and component bundles
+    images/<digest>/<name>.<fmt>        page images, already content-hashed
+    manifest.json                       {"pages": {page: hash}}
+
+so a page load is a handful of GETs of files that never change under
+their name, except the small index.html. Any static host can serve it.
+With SNAPSHOT_DIR set, app.py answers page GETs from it as well (see
+install), and /<page>?live=1 gets the live page.
+"""
+import os
+import re
+import json
+import argparse
+import importlib
+from flask import abort, request, send_file
+import artifacts
+from callback_requests import callback_body, first_load_values
+
+snapshot_dir = os.environ.get("SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot"))
+
+manifest_name = "manifest.json"
+suites = "/_dash-component-suites/"
+
+def _write(path, data):
+    #temp name first, so a half-written file is never served
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def walk(node):
+    """Every component in layout json [node], parents first."""
+    if isinstance(node, list):
+        for n in node:
+            yield from walk(n)
+    elif isinstance(node, dict) and "props" in node:
+        yield node
+        yield from walk(node["props"].get("children"))
+
+def prune(node):
+    """Layout json [node] without its live-only components."""
+    if isinstance(node, list):
+        return [n for n in (prune(c) for c in node) if n is not None]
+    if isinstance(node, dict) and "props" in node:
+        if "live-only" in (node["props"].get("className") or "").split():
+            return None
+        if "children" in node["props"]:
+            node["props"]["children"] = prune(node["props"]["children"])
+    return node
+
+def fill(app, client, content, values):
+    """Set the props of components in page [content] that callbacks of
+    the app module [app] fill, to their first-load responses."""
+    ids = {n["props"]["id"]: n for n in walk(content) if "id" in n["props"]}
+    for output, callback in app.app.callback_map.items():
+        outs = [o.rsplit(".", 1) for o in output.strip(".").split("...")]
+        if not all(i in ids for i, _ in outs):
+            continue
+        inputs = [(i["id"], i["property"]) for i in callback["inputs"]]
+        resp = client.post("/_dash-update-component",
+                json=callback_body(output, inputs, values))
+        if resp.status_code != 200:
+            raise RuntimeError("{} answered {}".format(output, resp.status_code))
+        for i, props in resp.get_json()["response"].items():
+            ids[i]["props"].update(props)
+
+def page_layout(app, client, page, values, live_url=""):
+    """Layout json of [page] with its content rendered and filled in."""
+    values = dict(values)
+    values[("url", "pathname")] = "/" + page
+    body = callback_body("page-content.children",
+            [("url", "pathname"), ("year", "value")], values)
+    content = client.post("/_dash-update-component", json=body).get_json()
+    content = content["response"]["page-content"]["children"]
+    fill(app, client, content, values)
+
+    note = {"type": "P", "namespace": "dash_html_components", "props": {
+        "className": "text-muted", "children": [
+            "GSS {}, static snapshot. ".format(values[("year", "value")]),
+            {"type": "A", "namespace": "dash_html_components", "props": {
+                "children": "Interactive version",
+                "href": "{}/{}?live=1".format(live_url.rstrip("/"), page)}}]}}
+    layout = client.get("/_dash-layout").get_json()
+    for n in walk(layout):
+        if n["props"].get("id") == "page-content":
+            n["props"]["children"] = [note, content]
+        elif n["type"] == "NavLink":
+            #a static page has no callbacks to swap the content in place
+            n["props"]["external_link"] = True
+            n["props"]["active"] = n["props"].get("id") == page
+    return prune(layout)
+
+def index_html(index, prefix):
+    """Dash's [index] page, asking for its layout under [prefix]."""
+    def point(m):
+        config = json.loads(m.group(2))
+        config["requests_pathname_prefix"] = prefix
+        return m.group(1) + json.dumps(config) + m.group(3)
+    return re.sub(r'(<script id="_dash-config" type="application/json">)(.*?)(</script>)',
+            point, index, flags=re.S)
+
+def copy_suites(client, index, out):
+    """Write the scripts and stylesheets [index] loads, with the async
+    chunks next to them, under [out]."""
+    for url in re.findall(r'(?:src|href)="(/_dash-component-suites/[^"?]+|/_favicon\.ico)', index):
+        data = client.get(url).get_data()
+        _write(os.path.join(out, url.lstrip("/")), data)
+        if not url.startswith(suites):
+            continue
+        #chunks (graph, markdown, plotly.js) load on demand from the same
+        #folder, plain or with a fingerprint like the one baked in the bundle
+        folder = url.rsplit("/", 1)[0]
+        pkg, _, rel = folder[len(suites):].partition("/")
+        pkg_dir = os.path.join(os.path.dirname(importlib.import_module(pkg).__file__), rel)
+        tokens = set(re.findall(r'"(v\d+_\d+_\d+m\d+)"', data.decode("utf-8", "replace")))
+        tokens |= set(re.findall(r"\.(v\d+_\d+_\d+m\d+)\.", url))
+        for name in os.listdir(pkg_dir):
+            if not (name.startswith("async-") and name.endswith(".js")):
+                continue
+            chunk = client.get("{}/{}".format(folder, name)).get_data()
+            stem = name[:-len(".js")]
+            for fname in [name] + ["{}.{}.js".format(stem, t) for t in sorted(tokens)]:
+                _write(os.path.join(out, folder.lstrip("/"), fname), chunk)
+
+def build(app, out=snapshot_dir, live_url=""):
+    """Render every page of the app module [app] to [out], see above.
+    Earlier _snap folders are kept, pages cached elsewhere may use them."""
+    client = app.server.test_client()
+    index = client.get("/?live=1").get_data(as_text=True)
+    copy_suites(client, index, out)
+    values = first_load_values(app)
+
+    manifest = {"pages": {}}
+    for page in app.pages:
+        layout = page_layout(app, client, page, values, live_url)
+        data = json.dumps(layout, separators=(",", ":")).encode("utf-8")
+        digest = artifacts.digest(data)
+        _write(os.path.join(out, "_snap", digest, "_dash-layout"), data)
+        _write(os.path.join(out, "_snap", digest, "_dash-dependencies"), b"[]")
+        html = index_html(index, "/_snap/{}/".format(digest)).encode("utf-8")
+        _write(os.path.join(out, page, "index.html"), html)
+        if page == app.pages[0]:
+            _write(os.path.join(out, "index.html"), html)
+        for n in walk(layout):
+            src = n["props"].get("src") or ""
+            if n["type"] == "Img" and src.startswith("/images/"):
+                _write(os.path.join(out, src.lstrip("/")), client.get(src).get_data())
+        manifest["pages"][page] = digest
+    #manifest goes last, it is what marks the snapshot as finished
+    _write(os.path.join(out, manifest_name),
+            json.dumps(manifest, indent=1).encode("utf-8"))
+    return manifest
+
+def install(server, path=snapshot_dir, max_age=300):
+    """Answer GETs of the pages in [path]'s snapshot from its files on
+    the Flask [server], unless they ask for ?live=1."""
+    with open(os.path.join(path, manifest_name)) as f:
+        pages = list(json.load(f)["pages"])
+    routes = {"/": pages[0]}
+    for page in pages:
+        routes["/" + page] = routes["/{}/".format(page)] = page
+
+    @server.before_request
+    def serve_snapshot():
+        if request.method != "GET" or "live" in request.args:
+            return None
+        page = routes.get(request.path)
+        if page is None:
+            return None
+        return send_file(os.path.join(path, page, "index.html"),
+                mimetype="text/html", max_age=max_age)
+
+    @server.route("/_snap/<digest>/<name>")
+    def snapshot_layout(digest, name):
+        if name not in ("_dash-layout", "_dash-dependencies") \
+                or not re.fullmatch(r"[0-9a-f]+", digest):
+            abort(404)
+        file = os.path.join(path, "_snap", digest, name)
+        if not os.path.exists(file):
+            abort(404)
+        resp = send_file(file, mimetype="application/json", etag=digest)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default=snapshot_dir)
+    parser.add_argument("--live-url", default="",
+            help="where the interactive app runs (default: the snapshot's host)")
+    args = parser.parse_args()
+    #build from the live app even if this environment serves a snapshot
+    os.environ.pop("SNAPSHOT_DIR", None)
+    import app
+    manifest = build(app, args.out, args.live_url)
+    print("{} pages in {}".format(len(manifest["pages"]), args.out))
@@ -0,0 +1,170 @@
+"""Survey-weighted statistics using the GSS `weight` (wtss) column.
+
+Every function groups by any list of categorical keys in one pass:
+rows get one integer group code and each statistic is a few
+np.bincount / sorted-array operations over all groups at once, with
+no per-group Python. Rows with a missing key, value or weight are left
+out, as in pandas groupby, and so are rows without a positive
+weight.
+
+    python survey_stats.py   # compare against groupby().apply
+"""
+import numpy as np
+import pandas as pd
+
+def group_codes(df, by):
+    """Integer group code per row of [df] for keys [by] (-1 when any key
+    is missing) and a frame of the key values for each code."""
+    if not by:
+        return np.zeros(len(df), dtype=np.intp), pd.DataFrame(index=[0])
+    by = [by] if isinstance(by, str) else list(by)
+    codes, uniques = [], []
+    for k in by:
+        col = df[k]
+        if hasattr(col, "cat"):
+            c, u = col.cat.codes.to_numpy(), col.cat.categories
+        else:
+            c, u = pd.factorize(col, sort=True)
+        codes.append(np.asarray(c, dtype=np.intp))
+        uniques.append(u)
+    shape = tuple(len(u) for u in uniques)
+    missing = np.any([c < 0 for c in codes], axis=0)
+    flat = np.ravel_multi_index([np.where(missing, 0, c) for c in codes], shape)
+    #compact to the key combinations that actually occur, in sorted order
+    present, compact = np.unique(flat[~missing], return_inverse=True)
+    out = np.full(len(df), -1, dtype=np.intp)
+    out[~missing] = compact
+    keys = pd.DataFrame({k: np.asarray(u)[idx] for k, u, idx in
+                        zip(by, uniques, np.unravel_index(present, shape))})
+    return out, keys
+
+def _valid(df, codes, weight, *cols):
+    #NaN and zero weights both drop out here
+    ok = (codes >= 0) & (df[weight].to_numpy(dtype=float) > 0)
+    for c in cols:
+        ok &= df[c].notna().to_numpy()
+    return ok
+
+def weighted_mean(df, value, weight="weight", by=None):
+    """Weighted mean of [value] per group, with row counts and weight totals."""
+    codes, keys = group_codes(df, by)
+    ok = _valid(df, codes, weight, value)
+    g, w = codes[ok], df[weight].to_numpy(dtype=float)[ok]
+    x = df[value].to_numpy(dtype=float)[ok]
+    ng = len(keys)
+    sw = np.bincount(g, weights=w, minlength=ng)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(g, weights=w * x, minlength=ng) / sw
+    return keys.assign(**{value: mean, "n": np.bincount(g, minlength=ng),
+                        "weight_total": sw})
+
+def weighted_quantile(df, value, q=0.5, weight="weight", by=None):
+    """Weighted quantiles of [value] per group. Each observation sits at
+    the midpoint of its share of the group's cumulative weight and
+    values are interpolated linearly in between, which matches
+    np.quantile(..., method='hazen') when all weights are equal."""
+    qs = np.atleast_1d(q).astype(float)
+    codes, keys = group_codes(df, by)
+    ok = _valid(df, codes, weight, value)
+    g, w = codes[ok], df[weight].to_numpy(dtype=float)[ok]
+    x = df[value].to_numpy(dtype=float)[ok]
+    ng = len(keys)
+
+    #one sort by (group, value) serves every group and every quantile
+    order = np.lexsort((x, g))
+    g, w, x = g[order], w[order], x[order]
+    total = np.bincount(g, weights=w, minlength=ng)
+    start = np.concatenate([[0], np.cumsum(np.bincount(g, minlength=ng))])
+    cw = np.cumsum(w)
+    before = np.concatenate([[0], cw])[start[:-1]]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        #position within the group in [0, 1], offset by group code so the
+        #whole array is sorted and one searchsorted finds every group
+        pos = g + (cw - before[g] - w / 2) / total[g]
+
+    out = {}
+    for qq in qs:
+        target = np.arange(ng) + qq
+        hi = np.clip(np.searchsorted(pos, target), start[:-1], np.maximum(start[1:] - 1, 0))
+        lo = np.clip(hi - 1, start[:-1], None)
+        span = pos[hi] - pos[lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.clip(np.where(span > 0, (target - pos[lo]) / span, 0), 0, 1)
+        val = x[lo] + frac * (x[hi] - x[lo])
+        out[qq] = np.where(start[1:] > start[:-1], val, np.nan)
+    for qq, v in out.items():
+        keys[value if len(qs) == 1 else qq] = v
+    return keys
+
+def weighted_median(df, value, weight="weight", by=None):
+    return weighted_quantile(df, value, 0.5, weight, by)
+
+def weighted_value_counts(df, column, weight="weight", by=None, normalize=False):
+    """Weighted count of each value of [column] per group, one row per
+    (group, value). With [normalize] counts become shares of the group."""
+    by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+    codes, keys = group_codes(df, by + [column])
+    ok = _valid(df, codes, weight)
+    w = df[weight].to_numpy(dtype=float)[ok]
+    counts = np.bincount(codes[ok], weights=w, minlength=len(keys))
+    keys = keys.assign(count=counts)
+    if normalize:
+        if by:
+            keys["count"] = counts / keys.groupby(by, observed=True)["count"].transform("sum").to_numpy()
+        else:
+            keys["count"] = counts / counts.sum()
+    return keys
+
+def weighted_ols(df, x, y, weight="weight", by=None):
+    """Weighted least squares fit of y = intercept + slope * x per group,
+    from bincount moment sums. Also returns the residual variance and
+    the x moments that confidence bands need."""
+    codes, keys = group_codes(df, by)
+    ok = _valid(df, codes, weight, x, y)
+    g, w = codes[ok], df[weight].to_numpy(dtype=float)[ok]
+    xv, yv = df[x].to_numpy(dtype=float)[ok], df[y].to_numpy(dtype=float)[ok]
+    ng = len(keys)
+    s = lambda v: np.bincount(g, weights=v, minlength=ng)
+    n = np.bincount(g, minlength=ng)
+    sw, sx, sy = s(w), s(w * xv), s(w * yv)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xbar, ybar = sx / sw, sy / sw
+        #centred moments, better conditioned than the raw sums
+        sxx = s(w * (xv - xbar[g]) ** 2)
+        sxy = s(w * (xv - xbar[g]) * (yv - ybar[g]))
+        slope = sxy / sxx
+        intercept = ybar - slope * xbar
+        resid = yv - intercept[g] - slope[g] * xv
+        sigma2 = s(w * resid ** 2) / (n - 2)
+    return keys.assign(slope=slope, intercept=intercept, n=n,
+                    weight_total=sw, xbar=xbar, sxx=sxx, sigma2=sigma2)
+
+if __name__ == '__main__':
+    import time
+    from gss_data import GSSDataset
+
+    gss_clean = GSSDataset().load()
+    #repeat the frame to see how both approaches scale with rows
+    for reps in (1, 10, 50):
+        df = pd.concat([gss_clean] * reps, ignore_index=True)
+        wm = lambda d: np.average(d.income, weights=d.weight)
+        def wmed(d):
+            d = d.sort_values("income")
+            cw = d.weight.cumsum()
+            return d.income[cw >= cw.iloc[-1] / 2].iloc[0]
+        cases = [
+            ("mean by sex",
+                lambda: weighted_mean(df, "income", by="sex"),
+                lambda: df.dropna(subset=["income", "weight"]).groupby("sex").apply(wm)),
+            ("mean by sex x region",
+                lambda: weighted_mean(df, "income", by=["sex", "region"]),
+                lambda: df.dropna(subset=["income", "weight"]).groupby(["sex", "region"]).apply(wm)),
+            ("median by sex x region",
+                lambda: weighted_median(df, "income", by=["sex", "region"]),
+                lambda: df.dropna(subset=["income", "weight"]).groupby(["sex", "region"]).apply(wmed)),
+        ]
+        for name, fast, naive in cases:
+            t = time.perf_counter(); fast(); tf = time.perf_counter() - t
+            t = time.perf_counter(); naive(); tn = time.perf_counter() - t
+            print("{:>8} rows  {:<24} vectorized {:8.2f}ms  groupby.apply {:8.2f}ms".format(
+                len(df), name, tf * 1000, tn * 1000))
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import gss_data
+import cube
+from survey_stats import weighted_quantile
+
+def frame(n=400, seed=0):
+    #cleaned rows whose income takes a few category midpoints, like coninc
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "sex": pd.Categorical(rng.choice(["female", "male"], n), dtype=gss_data.cat_type_sex),
+        "region": rng.choice(["pacific", "new england", "mountain"], n),
+        "age": rng.integers(18, 89, n).astype(float),
+        "education": rng.integers(8, 20, n).astype(float),
+        "job_prestige": rng.integers(20, 80, n).astype(float),
+        "socioeconomic_index": rng.uniform(10, 90, n),
+        "income": rng.choice([1500.0, 9000.0, 21000.0, 33000.0, 52000.0, 118000.0], n),
+        "weight": rng.uniform(0.5, 2, n),
+        **{c: pd.Categorical(rng.choice(answers, n), categories=answers)
+            for c, answers in cube.likert.items()}})
+
+def test_discrete_income_quantiles_are_exact():
+    df = frame()
+    c = cube.GSSCube(df)
+    assert c.income_exact
+    qs = [0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0]
+    got = c.quantiles(qs, by=("sex", "region")).set_index(["sex", "region"])
+    ref = weighted_quantile(df.assign(_u=1.0), "income", qs, weight="_u",
+                            by=["sex", "region"]).set_index(["sex", "region"])
+    np.testing.assert_allclose(got[qs].to_numpy(float),
+                            ref.reindex(got.index)[qs].to_numpy(float))
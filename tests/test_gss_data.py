@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import gss_data
+
+def raw_rows(year, n, start_id, answered=True):
+    #rows of the cumulative csv; unanswered rows leave every text column empty
+    rng = np.random.default_rng(year + start_id)
+    text = lambda values: rng.choice(values, n) if answered else [np.nan] * n
+    return pd.DataFrame({
+        "year": year, "id": np.arange(start_id, start_id + n),
+        "wtss": rng.uniform(0.5, 2, n).round(4),
+        "sex": rng.choice(["female", "male"], n),
+        "educ": rng.integers(8, 20, n).astype(float),
+        "region": text(["pacific", "new england"]),
+        "age": rng.integers(18, 89, n).astype(str),
+        "coninc": rng.uniform(1000, 90000, n).round(0),
+        "prestg10": rng.integers(20, 80, n).astype(float),
+        "mapres10": rng.integers(20, 80, n).astype(float),
+        "papres10": rng.integers(20, 80, n).astype(float),
+        "sei10": rng.uniform(10, 90, n).round(1),
+        "satjob": text(["very satisfied", "mod. satisfied"]),
+        **{c: text(gss_data.cat_order)
+            for c in ["fechld", "fefam", "fepol", "fepresch", "meovrwrk"]}})
+
+def test_year_split_across_chunks(tmp_path, monkeypatch):
+    #2012 straddles the chunk boundary at 100 rows, and its sliver in the
+    #first chunk has nothing but missing text columns
+    source = tmp_path / "cumulative.csv"
+    pd.concat([raw_rows(2010, 95, 0), raw_rows(2012, 5, 95, answered=False),
+            raw_rows(2012, 40, 100), raw_rows(2014, 55, 140)]
+            ).to_csv(source, index=False)
+    monkeypatch.setattr(gss_data, "cache_dir", str(tmp_path / "cache"))
+    gss_data.partition_by_year(str(source), chunksize=100)
+
+    dataset = gss_data.GSSDataset(cumulative_source=str(source), shared=False)
+    assert dataset.years() == [2010, 2012, 2014]
+    df = dataset.load(2012)
+    assert len(df) == 45
+    assert df.region.isna().sum() == 5
+    assert df.male_breadwinner.dtype == gss_data.cat_type
+    assert sum(len(b) for b in dataset.iter_batches(2012)) == 45
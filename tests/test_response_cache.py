@@ -0,0 +1,14 @@
+import response_cache
+
+def body(changed):
+    return {"output": "prestige-graph.figure",
+            "inputs": [{"id": "year", "property": "value", "value": 2018},
+                    {"id": "prestige-graph", "property": "relayoutData",
+                        "value": {"xaxis.range[0]": 30, "xaxis.range[1]": 50}}],
+            "changedPropIds": changed}
+
+def test_key_keeps_trigger_only_when_asked():
+    cache = response_cache.ResponseCache()
+    by_year, by_zoom = body(["year.value"]), body(["prestige-graph.relayoutData"])
+    assert cache.key(by_year) == cache.key(by_zoom)
+    assert cache.key(by_year, triggered=True) != cache.key(by_zoom, triggered=True)
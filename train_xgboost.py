@@ -0,0 +1,200 @@
+"""Train the income model behind the AI page and write gss_xgboost_df.csv.
+
+    python train_xgboost.py [--year YEAR] [--out CSV] [--force]
+
+Builds one-hot features from the cleaned GSS frame with the names the
+csv has always used ("SEX: Female", "REGION: Pacific", ...), fits a
+gradient boosted regressor on income with histogram tree building on
+every core, and writes feature, coefficient, importance, imp_pct and
+positive. importance is the total gain of a feature's splits;
+permutation importances (computed in parallel on a holdout set) go to
+a second csv in the same schema. coefficient is the feature's slope in
+a weighted linear fit on standardized values, positive is its sign
+as a color.
+
+A run is skipped when the source data, the year and the settings are
+the same as for the csv already written; --force trains anyway.
+Needs xgboost and scikit-learn, which are not in requirements.txt as
+the web dyno never trains.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from gss_data import GSSDataset, source_fingerprint, clean_config, cache_dir, colorder, xgb_local_csv
+from profiling import stage
+
+#where the app looks for it, see gss_data.xgb_csv()
+out_csv = xgb_local_csv
+
+numeric_features = ['age', 'job_prestige', 'father_job_prestige',
+                    'mother_job_prestige', 'education']
+category_features = ['region', 'satjob'] + colorder
+
+#bump this whenever feature_matrix() or train() change in a way train_config can't see
+TRAIN_VERSION = 1
+
+#everything the csv depends on besides the data
+train_config = {"n_estimators": 300, "max_depth": 4, "learning_rate": 0.05,
+                "subsample": 0.8, "colsample_bytree": 0.8,
+                "test_size": 0.2, "permutation_repeats": 5, "seed": 42}
+
+def feature_name(column, value=None):
+    """Display name of a feature, e.g. ("male_breadwinner", "agree")
+    -> "MALE BREADWINNER: Agree", ("job_prestige",) -> "Job Prestige"."""
+    if value is None:
+        return column.replace("_", " ").title()
+    return "{}: {}".format(column.replace("_", " ").upper(), str(value).title())
+
+def feature_matrix(gss_clean):
+    """(X, y, weight) for rows with an income. X holds the numeric
+    features, a female indicator and one column per answer given for
+    each categorical, named by feature_name(). Missing stays NaN."""
+    df = gss_clean[gss_clean.income.notna()]
+    X = pd.DataFrame({feature_name(c): df[c].astype("float32") for c in numeric_features},
+                    index=df.index)
+    X[feature_name("sex", "female")] = (df.sex == "female").astype("float32").where(df.sex.notna())
+    for c in category_features:
+        col = df[c].astype("category")
+        for value in col.cat.categories:
+            if (col == value).any():
+                X[feature_name(c, value)] = (col == value).astype("float32")
+    return X, df.income.to_numpy(dtype=float), df.weight.fillna(0).to_numpy(dtype=float)
+
+def linear_coefficients(X, y, weight):
+    """Slopes of a weighted least squares fit of standardized [y] on
+    standardized [X] (missing values at the column mean). Collinear
+    dummy groups get the minimum norm solution."""
+    Z = X.fillna(X.mean()).to_numpy(dtype=float)
+    sd = Z.std(axis=0)
+    Z = (Z - Z.mean(axis=0)) / np.where(sd > 0, sd, 1)
+    Z = np.column_stack([np.ones(len(Z)), Z])
+    sw = np.sqrt(np.clip(weight, 0, None))
+    y = (y - y.mean()) / (y.std() or 1)
+    beta = np.linalg.lstsq(Z * sw[:, None], y * sw, rcond=None)[0]
+    return pd.Series(beta[1:], index=X.columns)
+
+def importance_frame(importance, coefficient):
+    """Rows in the gss_xgboost_df.csv schema, largest importance first."""
+    out = pd.DataFrame({"feature": importance.index,
+                        "coefficient": coefficient.reindex(importance.index).to_numpy(),
+                        "importance": importance.to_numpy()})
+    out["imp_pct"] = (100 * out.importance / out.importance.sum()).round(3)
+    out["positive"] = np.where(out.coefficient < 0, "red", "black")
+    return out.sort_values("importance", ascending=False, ignore_index=True)
+
+def make_model(n_jobs=-1, config=train_config):
+    """Unfitted regressor with the training settings in [config]."""
+    from xgboost import XGBRegressor
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    return XGBRegressor(tree_method="hist", n_jobs=n_jobs,
+                random_state=config["seed"],
+                n_estimators=config["n_estimators"], max_depth=config["max_depth"],
+                learning_rate=config["learning_rate"], subsample=config["subsample"],
+                colsample_bytree=config["colsample_bytree"])
+
+def split(X, y, weight, config=train_config):
+    """(X_train, X_test, y_train, y_test, w_train, w_test), the same
+    split every time for the same config."""
+    from sklearn.model_selection import train_test_split
+    return train_test_split(X, y, weight, test_size=config["test_size"],
+                            random_state=config["seed"])
+
+def fit_model(gss_clean, n_jobs=-1, config=train_config):
+    """(fitted model, X, split) for [gss_clean]."""
+    X, y, weight = feature_matrix(gss_clean)
+    parts = split(X, y, weight, config)
+    X_train, _, y_train, _, w_train, _ = parts
+    model = make_model(n_jobs, config)
+    with stage("train", rows=len(X_train), features=X.shape[1]):
+        model.fit(X_train, y_train, sample_weight=w_train)
+    return model, X, parts
+
+def train(gss_clean, n_jobs=-1, config=train_config):
+    """Fit the model and return (gain frame, permutation frame, holdout r2)."""
+    from sklearn.inspection import permutation_importance
+
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    model, X, parts = fit_model(gss_clean, n_jobs, config)
+    X_train, X_test, y_train, y_test, w_train, w_test = parts
+
+    gain = pd.Series(model.get_booster().get_score(importance_type="total_gain"))
+    gain = gain.reindex(X.columns, fill_value=0.0).round().astype("int64")
+
+    #each permutation worker predicts on its own, so the model gets one thread
+    model.set_params(n_jobs=1)
+    with stage("permutation_importance", repeats=config["permutation_repeats"]):
+        perm = permutation_importance(model, X_test, y_test, sample_weight=w_test,
+                    n_repeats=config["permutation_repeats"],
+                    random_state=config["seed"], n_jobs=n_jobs)
+    perm = pd.Series(np.clip(perm.importances_mean, 0, None), index=X.columns)
+
+    coefficient = linear_coefficients(X_train, y_train, w_train)
+    r2 = model.score(X_test, y_test, sample_weight=w_test)
+    return importance_frame(gain, coefficient), importance_frame(perm, coefficient), r2
+
+def permutation_path(out):
+    root, ext = os.path.splitext(out)
+    return root + "_permutation" + ext
+
+def stamp_key(dataset, year, config=train_config):
+    """Hash of everything the csv depends on: the source file, the
+    cleaning config, the year and the training config."""
+    raw = json.dumps([source_fingerprint(dataset.cumulative_source or dataset.source),
+                    clean_config(), year, TRAIN_VERSION, config], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+def stamp_path(out):
+    name = hashlib.sha256(os.path.abspath(out).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "xgboost-{}.stamp".format(name))
+
+def up_to_date(out, key):
+    try:
+        with open(stamp_path(out)) as f:
+            return f.read() == key and os.path.exists(out)
+    except OSError:
+        return False
+
+def _write_csv(frame, path):
+    #write to a temp name first so the app never reads half a file
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    frame.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+def regenerate(out=out_csv, year=None, force=False, n_jobs=-1, dataset=None):
+    """Train and write [out] (and its permutation csv) unless they are
+    already up to date. Returns the holdout r2, or None if skipped."""
+    dataset = dataset or GSSDataset()
+    year = dataset.default_year if year is None else int(year)
+    key = stamp_key(dataset, year)
+    if not force and up_to_date(out, key):
+        return None
+
+    gain, perm, r2 = train(dataset.load(year), n_jobs=n_jobs)
+    _write_csv(gain, out)
+    _write_csv(perm, permutation_path(out))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(stamp_path(out), "w") as f:
+            f.write(key)
+    except OSError:
+        pass
+    return r2
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--year", type=int, help="survey year (default: latest)")
+    parser.add_argument("--out", default=out_csv, help="csv to write (default: %(default)s)")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="cores to use (default: all)")
+    parser.add_argument("--force", action="store_true", help="train even if up to date")
+    args = parser.parse_args()
+
+    start = time.time()
+    r2 = regenerate(args.out, args.year, args.force, args.n_jobs)
+    if r2 is None:
+        print("{} is up to date".format(args.out))
+    else:
+        print("wrote {} (holdout r2 {:.3f}) in {:.1f}s".format(args.out, r2, time.time() - start))
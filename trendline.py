@@ -0,0 +1,45 @@
+import numpy as np
+import plotly.graph_objects as go
+from statistics import NormalDist
+from survey_stats import weighted_ols
+
+def fit_lines(df, x, y, by, weight=None):
+    """Least squares fit of [y] on [x] per [by] group, closed form.
+    Without [weight] every row counts once, as px trendline='ols' does."""
+    if weight is None:
+        df = df.assign(_w=1.0)
+        weight = "_w"
+    return weighted_ols(df, x, y, weight=weight, by=by)
+
+def add_trendlines(fig, df, x, y, color, weight=None, ci=None, points=50, colors=None):
+    """Add a fitted line per [color] group to scatter [fig], drawn in the
+    colour of the group's markers or as given in [colors] {group: colour}.
+    [ci] (e.g. 0.95) adds a confidence band for the mean response."""
+    fits = fit_lines(df, x, y, color, weight)
+    if colors is None:
+        colors = {t.name: t.marker.color for t in fig.data if t.name is not None}
+    z = NormalDist().inv_cdf(0.5 + ci / 2) if ci else None
+    for _, fit in fits.iterrows():
+        group = str(fit[color])
+        xs = df.loc[df[color] == fit[color], x].dropna()
+        if xs.empty or np.isnan(fit["slope"]):
+            continue
+        grid = np.linspace(xs.min(), xs.max(), points if ci else 2)
+        line = fit["intercept"] + fit["slope"] * grid
+        if ci:
+            se = np.sqrt(fit["sigma2"] * (1 / fit["weight_total"] +
+                        (grid - fit["xbar"]) ** 2 / fit["sxx"]))
+            fig.add_trace(go.Scatter(
+                x=np.concatenate([grid, grid[::-1]]),
+                y=np.concatenate([line + z * se, (line - z * se)[::-1]]),
+                fill="toself", mode="lines", line=dict(width=0),
+                fillcolor=colors.get(group), opacity=0.2,
+                legendgroup=group, showlegend=False, hoverinfo="skip"))
+        fig.add_trace(go.Scatter(
+            x=grid, y=line, mode="lines",
+            line=dict(color=colors.get(group)),
+            name=group, legendgroup=group, showlegend=False,
+            hovertemplate="<b>OLS trendline</b><br>{} = {:.4g} * {} + {:.6g}"
+                "<br>n={:d}<extra></extra>".format(
+                y, fit["slope"], x, fit["intercept"], int(fit["n"]))))
+    return fig
@@ -1,24 +1,33 @@
+import os
+import re
+import json
+import hashlib
+import urllib.request
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import colors as pltcolors
-import pandas as pd 
+import pandas as pd
 from io import BytesIO
 import base64
-
-rawcsv = r"https://raw.githubusercontent.com/kipmccharen/dash-heroku-template/master/gss_xgboost_df.csv"
+from gss_data import cache_dir, xgb_csv
 
 #define categories of items
-labelsdicts = [{"name": "Born Female", "inkey": ["SEX: Female"], 
+labelsdicts = [{"name": "Born Female", "inkey": ["SEX: Female"],
                 "order": 2, "color":"orangered"},
-        {"name": "Hometown Region", "inkey": ["REGION"], 
+        {"name": "Hometown Region", "inkey": ["REGION"],
                 "order": 4, "color":"dimgrey"},
-        {"name": "Beliefs", "inkey": ["gree", "isfied", "Dissat"], 
+        {"name": "Beliefs", "inkey": ["gree", "isfied", "Dissat"],
                 "order": 3, "color":"midnightblue"},
-        {"name": "Upbringing/Age", "inkey": [], 
+        {"name": "Upbringing/Age", "inkey": [],
                 "order": 1, "color":"black"}]
 
+#style of the chart in the dashboard and in the original notebook
+app_style = {"font_size": 10, "figsize": (8, 12),
+            "adjust": {"left": 0.4, "bottom": 0.01, "top": 1}}
+notebook_style = {"font_size": 14, "figsize": (7, 12), "adjust": None}
+
 def anylist_in_string(src_list, string):
-    """Return True if any value in [src_list] 
+    """Return True if any value in [src_list]
     exists in given [string]."""
     if not src_list or not string:
         return False
@@ -28,14 +37,20 @@ def anylist_in_string(src_list, string):
     return False
 
 def addcolor(x):
-    """Vectorized color value from lookup dictionary."""
-    out = None
-    for ld in [a for a in labelsdicts if a["inkey"]]:
-        if anylist_in_string(ld['inkey'], x):
-            out = ld["color"]
-    if not out:
-        out = "black"
-    return pltcolors.to_rgba(out)
+    """Color value from lookup dictionary for a single feature."""
+    return feature_colors(pd.Series([x]))[0]
+
+def feature_colors(features):
+    """RGBA color for each of [features], one regex match per category.
+    Later categories in labelsdicts win, unmatched features are black."""
+    names = np.full(len(features), "black", dtype=object)
+    for ld in labelsdicts:
+        if not ld["inkey"]:
+            continue
+        pattern = "|".join(re.escape(k) for k in ld["inkey"])
+        hit = features.str.contains(pattern, regex=True, na=False).to_numpy()
+        names[hit] = ld["color"]
+    return [pltcolors.to_rgba(c) for c in names]
 
 #from https://github.com/4QuantOSS/DashIntro/blob/master/notebooks/Tutorial.ipynb
 def fig_to_uri(in_fig, close_all=True, **save_args):
@@ -45,71 +60,120 @@ def fig_to_uri(in_fig, close_all=True, **save_args):
     :param in_fig:
     :return:
     """
+    return png_to_uri(fig_to_bytes(in_fig, close_all, **save_args))
+
+def fig_to_bytes(in_fig, close_all=True, fmt="png", **save_args):
+    """Save a figure as image bytes."""
     out_img = BytesIO()
-    in_fig.savefig(out_img, format='png', **save_args)
+    in_fig.savefig(out_img, format=fmt, **save_args)
     if close_all:
         in_fig.clf()
         plt.close('all')
-    out_img.seek(0)  # rewind file
-    encoded = base64.b64encode(out_img.read()).decode("ascii").replace("\n", "")
+    return out_img.getvalue()
+
+def png_to_uri(png):
+    encoded = base64.b64encode(png).decode("ascii").replace("\n", "")
     return "data:image/png;base64,{}".format(encoded)
 
-def make_xgboost_plot():
-    xg_df = pd.read_csv(rawcsv)
-
-    #add color to each feature from dict above
-    xg_df['color'] = xg_df.feature.apply(addcolor)
-
-    #set base font size
-    plt.rcParams.update({'font.size': 14})
-
-    #create plot and set figure size
-    statfig,statax = plt.subplots(figsize = (7,12))
-
-    #create bar chart
-    statax.barh(xg_df.feature, xg_df.imp_pct, align='center')
-    #add feature names as labels
-    statax.set_yticks(xg_df.feature)
-    #turn on size to make horizontal bar chart
-    statax.invert_yaxis()
-    #remove outer box and x axis as unnecessary
-    statax.spines["top"].set_visible(False)
-    statax.spines["right"].set_visible(False)
-    statax.spines["bottom"].set_visible(False)
-    statax.get_xaxis().set_visible(False)
-
-    # for each feature:
-    # - add text to end of bar
-    # - color the bar itself
-    for i in range(len(xg_df.index)):
-        rw = xg_df.iloc[i,:]
+def render_importance(xg_df, font_size=10, figsize=(8,12), adjust=None, fmt="png",
+                    intervals=None):
+    """Draw the feature importance bar chart for [xg_df] (columns
+    feature, imp_pct, positive) and return the image bytes. [intervals]
+    ({feature: {"estimate", "lo", "hi"}} in percent, see bootstrap.py)
+    adds error bars, and those features are drawn at the bootstrap
+    estimate the interval belongs to instead of the csv's imp_pct,
+    which comes from a different fit."""
+    xerr = None
+    if intervals:
+        est = [intervals.get(f, {}).get("estimate", p) for f, p in zip(xg_df.feature, xg_df.imp_pct)]
+        xg_df = xg_df.assign(imp_pct=est).sort_values("imp_pct", ascending=False,
+                                                    ignore_index=True)
+        lo = np.array([intervals.get(f, {}).get("lo", p) for f, p in zip(xg_df.feature, xg_df.imp_pct)])
+        hi = np.array([intervals.get(f, {}).get("hi", p) for f, p in zip(xg_df.feature, xg_df.imp_pct)])
+        xerr = [np.clip(xg_df.imp_pct - lo, 0, None), np.clip(hi - xg_df.imp_pct, 0, None)]
+    colors = feature_colors(xg_df.feature)
+    ends = xg_df.imp_pct if xerr is None else xg_df.imp_pct + xerr[1]
+
+    with plt.rc_context({'font.size': font_size}):
+        #create plot and set figure size
+        statfig,statax = plt.subplots(figsize = figsize)
+
+        #create bar chart, each bar in its category color
+        statax.barh(xg_df.feature, xg_df.imp_pct, align='center',
+                color=colors, edgecolor=colors, xerr=xerr,
+                error_kw={"ecolor": "grey", "capsize": 2, "elinewidth": 1})
+        #add feature names as labels
+        statax.set_yticks(xg_df.feature)
+        #turn on size to make horizontal bar chart
+        statax.invert_yaxis()
+        #remove outer box and x axis as unnecessary
+        statax.spines["top"].set_visible(False)
+        statax.spines["right"].set_visible(False)
+        statax.spines["bottom"].set_visible(False)
+        statax.get_xaxis().set_visible(False)
 
         #add text to end of each bar with appropriate color
-        statax.text(x=rw['imp_pct'] +0.1, y=i, 
-                s=str(round(rw['imp_pct'],2)) + '%',
-                va = 'center', 
-                color=rw["positive"],
-                fontweight='bold')
-        #statax color of each bar
-        statax.get_children()[i].set_color(rw["color"])
-
-    tsh = 12 #text start height
-
-    #for each category of bar, add text in the plot
-    for use_item in labelsdicts:
-        statax.text(7, tsh-6+use_item["order"]*1.2,
-                use_item["name"], 
-                color=pltcolors.to_rgba(use_item["color"]), 
-                fontsize='large', 
-                fontweight='bold')
-
-    #add text explaining meaning of number color
-    statax.text(7,tsh + 1.5,"reduces",color="red",fontweight='bold')
-    statax.text(11,tsh + 1.5,"increases",color="black",fontweight='bold')
-
-    #final labels
-    #statax.set_title("AI-Predicted % Importance on Income\n(independent of other features)")
-    #statax.text(5,tsh + 4,"Source: 2018 General Social Survey (GSS)")
-    statax.set_ylabel('')
-
-    return fig_to_uri(statfig)
\ No newline at end of file
+        for i, (pct, end, positive) in enumerate(zip(xg_df.imp_pct, ends, xg_df.positive)):
+            statax.text(x=end +0.1, y=i,
+                    s=str(round(pct,2)) + '%',
+                    va = 'center',
+                    color=positive,
+                    fontweight='bold')
+
+        tsh = 12 #text start height
+
+        #for each category of bar, add text in the plot
+        for use_item in labelsdicts:
+            statax.text(7, tsh-6+use_item["order"]*1.2,
+                    use_item["name"],
+                    color=pltcolors.to_rgba(use_item["color"]),
+                    fontsize='large',
+                    fontweight='bold')
+
+        #add text explaining meaning of number color
+        statax.text(7,tsh + 1.5,"reduces",color="red",fontweight='bold')
+        statax.text(11,tsh + 1.5,"increases",color="black",fontweight='bold')
+
+        #final labels
+        #statax.set_title("AI-Predicted % Importance on Income\n(independent of other features)")
+        #statax.text(5,tsh + 4,"Source: 2018 General Social Survey (GSS)")
+        statax.set_ylabel('')
+        if adjust:
+            statfig.subplots_adjust(**adjust)
+
+        return fig_to_bytes(statfig, fmt=fmt)
+
+def read_source(source):
+    """Raw bytes of a local path or URL."""
+    if os.path.exists(source):
+        with open(source, "rb") as f:
+            return f.read()
+    with urllib.request.urlopen(source) as resp:
+        return resp.read()
+
+def importance_image(source=None, fmt="png", intervals=None, **style):
+    """Importance chart bytes for the csv at [source]. Images are cached
+    on disk keyed by a hash of the csv contents, the intervals and the
+    style, so the chart is only drawn again when one of them changes."""
+    style = {**app_style, **style}
+    raw = read_source(source or xgb_csv())
+    key = hashlib.sha256(raw + json.dumps([style, fmt, intervals or {}],
+                        sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, "importance-{}.{}".format(key, fmt))
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    img = render_importance(pd.read_csv(BytesIO(raw)), fmt=fmt, intervals=intervals, **style)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(img)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return img
+
+def make_xgboost_plot():
+    return png_to_uri(importance_image(**notebook_style))